@@ -0,0 +1,835 @@
+#!/usr/bin/python3
+
+"""
+benchmark.py - performance measurements for the linenoise library.
+
+See: https://github.com/deadsy/py_linenoise
+
+"""
+
+import gc
+import os
+import pty
+import sys
+import tty
+import time
+import fcntl
+import select
+import struct
+import termios
+import threading
+import tracemalloc
+import linenoise
+
+# -----------------------------------------------------------------------------
+
+
+class syscall_counter:
+    """count the os.read() and select.select() calls made within a context"""
+
+    def __init__(self):
+        self.reads = 0
+        self.selects = 0
+
+    def __enter__(self):
+        self.os_read = os.read
+        self.select_select = select.select
+
+        def counted_read(fd, n):
+            self.reads += 1
+            return self.os_read(fd, n)
+
+        def counted_select(*args):
+            self.selects += 1
+            return self.select_select(*args)
+
+        os.read = counted_read
+        select.select = counted_select
+        return self
+
+    def __exit__(self, *args):
+        os.read = self.os_read
+        select.select = self.select_select
+
+    def total(self):
+        return self.reads + self.selects
+
+
+# -----------------------------------------------------------------------------
+# input: syscalls per byte for pasted input
+
+_PASTE_SIZE = 20 * 1024
+
+
+def paste_text(n):
+    """return n characters of printable text"""
+    s = "show interface ethernet0/1 counters | include errors ; "
+    return (s * (n // len(s) + 1))[:n]
+
+
+def read_paste(getc, n):
+    """read n characters with getc, return the elapsed time"""
+    t0 = time.perf_counter()
+    for _ in range(n):
+        getc()
+    return time.perf_counter() - t0
+
+
+def bench_input():
+    """syscalls per byte: per-byte _getc() versus the buffered input stream"""
+    data = paste_text(_PASTE_SIZE).encode("utf8")
+    n = len(data)
+    print("input: %d byte paste" % n)
+    results = []
+    # the legacy reader waits on each character with a timeout
+    (rfd, wfd) = os.pipe()
+    os.write(wfd, data)
+    with syscall_counter() as sc:
+        t = read_paste(lambda: linenoise._getc(rfd, linenoise._CHAR_TIMEOUT), n)
+    results.append(("_getc", sc, t))
+    os.close(rfd)
+    os.close(wfd)
+    # the buffered input stream
+    (rfd, wfd) = os.pipe()
+    os.write(wfd, data)
+    inp = linenoise.input_stream(rfd)
+    with syscall_counter() as sc:
+        t = read_paste(lambda: inp.getc(linenoise._CHAR_TIMEOUT), n)
+    results.append(("input_stream", sc, t))
+    os.close(rfd)
+    os.close(wfd)
+    for name, sc, t in results:
+        print(
+            "  %-14s reads %6d selects %6d syscalls/byte %.4f  %8.2f ms"
+            % (name, sc.reads, sc.selects, sc.total() / n, t * 1000.0)
+        )
+
+
+# -----------------------------------------------------------------------------
+# editing sessions on a pseudo terminal
+
+
+class pty_session:
+    """run linenoise.edit() on a pseudo terminal with scripted key input"""
+
+    def __init__(self, ln, cols=80):
+        self.ln = ln
+        self.cols = cols
+        self.output = 0  # number of bytes written to the terminal
+        self.elapsed = 0.0  # time spent in edit()
+        self.sent = []  # times the keys were written
+
+    def run(self, keys, prompt="> ", delay=0.0):
+        """
+        feed the keys to an edit session, return the line
+        keys is a string written in one go, or a list of keys written with a delay between them
+        """
+        (master, slave) = pty.openpty()
+        tty.setraw(slave)
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", 24, self.cols, 0, 0))
+        # the file descriptor may be reused, forget any cached geometry
+        linenoise._columns.pop(slave, None)
+
+        def writer():
+            for k in (keys,) if isinstance(keys, str) else keys:
+                self.sent.append(time.perf_counter())
+                data = k.encode("utf8")
+                while len(data):
+                    n = os.write(master, data)
+                    data = data[n:]
+                time.sleep(delay)
+
+        def reader():
+            while True:
+                try:
+                    data = os.read(master, 65536)
+                except OSError:
+                    break
+                if len(data) == 0:
+                    break
+                self.output += len(data)
+
+        threads = [threading.Thread(target=fn, daemon=True) for fn in (reader, writer)]
+        for t in threads:
+            t.start()
+        t0 = time.perf_counter()
+        line = self.ln.edit(slave, slave, prompt, "")
+        self.elapsed = time.perf_counter() - t0
+        # let the reader drain the output
+        time.sleep(0.1)
+        os.close(slave)
+        threads[0].join()
+        os.close(master)
+        return line
+
+
+# -----------------------------------------------------------------------------
+# paste: throughput for large pastes
+
+_PASTE_SIZES = (500, 2000, 5000)
+
+
+def bench_paste():
+    """large pastes: per character insertion versus bracketed paste"""
+    print("paste: edit() throughput")
+    for n in _PASTE_SIZES:
+        text = paste_text(n)
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.set_bracketed_paste(mode)
+            session = pty_session(ln)
+            if mode:
+                line = session.run("\x1b[200~%s\x1b[201~\r" % text)
+            else:
+                line = session.run("%s\r" % text)
+            assert line == text
+            print(
+                "  %6d chars %-10s output %9d bytes %8.2f ms %10.0f chars/s"
+                % (
+                    n,
+                    ("typed", "bracketed")[mode],
+                    session.output,
+                    session.elapsed * 1000.0,
+                    n / session.elapsed,
+                )
+            )
+
+
+# -----------------------------------------------------------------------------
+# render: output bytes for an editing session
+
+# a recorded editing session: type a long command, then go back and fix it up
+_LEFT = "\x1b[D"
+_RIGHT = "\x1b[C"
+_SESSION = (
+    list("show interface ethernet0/1 counters detail | include input errors | exclude crc")
+    + [_LEFT] * 40
+    + ["\x7f"] * 6
+    + list("output")
+    + [_RIGHT] * 12
+    + ["\x17", "\x17"]
+    + list("runts")
+    + ["\x01"]
+    + ["\x06"] * 5
+    + ["\x14", "\x05"]
+    + list(" | count")
+    + ["\x7f"] * 8
+    + ["\r"]
+)
+
+# time between keystrokes, so each key is refreshed on its own
+_KEY_DELAY = 0.002
+
+# 9600 baud, 8N1
+_BAUD = 9600
+_BITS_PER_BYTE = 10
+
+
+def bench_render():
+    """single line refresh: full versus differential over a recorded session"""
+    print("render: %d key session" % len(_SESSION))
+    for cols in (40, 80):
+        lines = []
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.set_diffmode(mode)
+            session = pty_session(ln, cols)
+            lines.append(session.run(_SESSION, delay=_KEY_DELAY))
+            print(
+                "  %3d cols %-12s output %7d bytes %7.2f s at %d baud"
+                % (
+                    cols,
+                    ("full", "differential")[mode],
+                    session.output,
+                    session.output * _BITS_PER_BYTE / _BAUD,
+                    _BAUD,
+                )
+            )
+        assert lines[0] == lines[1]
+
+
+# -----------------------------------------------------------------------------
+# search: per keystroke latency of the reverse history search
+
+_SEARCH_SIZES = (10000, 100000, 1000000)
+_WORDS = (
+    "show interface ethernet0/%d counters detail",
+    "ping 10.0.%d.1 repeat 5",
+    "configure terminal vlan %d",
+    "traceroute host%d.example.com",
+    "git commit -m 'fix issue %d'",
+)
+
+
+def history_lines(n):
+    """return n synthetic history lines"""
+    return [_WORDS[i % len(_WORDS)] % (i * 7919 % 100003) for i in range(n)]
+
+
+def bench_search():
+    """reverse history search: linear scan versus the trigram index"""
+    print("search: per keystroke latency")
+    # typed one key at a time, the last query is a rare line near the start of the history
+    query = "host23757.example"
+    for n in _SEARCH_SIZES:
+        lines = history_lines(n)
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(n)
+            for l in lines:
+                ln.history.append(l)
+            t0 = time.perf_counter()
+            ln.set_history_index(mode)
+            build = time.perf_counter() - t0
+            before = ln.history.first + n
+            worst = 0.0
+            for i in range(1, len(query) + 1):
+                t0 = time.perf_counter()
+                seq = ln.history_search(query[:i], before)
+                worst = max(worst, time.perf_counter() - t0)
+            assert query in ln.history.by_seq(seq)
+            print(
+                "  %7d lines %-7s build %8.2f ms worst keystroke %8.3f ms"
+                % (n, ("scan", "indexed")[mode], build * 1000.0, worst * 1000.0)
+            )
+
+
+# -----------------------------------------------------------------------------
+# prefix: latency of the prefix filtered history navigation
+
+
+def bench_prefix():
+    """prefix filtered Up: history scan versus the sorted prefix index"""
+    print("prefix: latency of the first and the next 9 Up presses, history_add() cost")
+    # short prefixes match much of the history, long ones a few lines
+    prefixes = ("s", "pi", "tra", "ping 10.0.1", "traceroute host2375")
+    for n in _SEARCH_SIZES:
+        lines = history_lines(n)
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(n)
+            for l in lines:
+                ln.history.append(l)
+            ln.set_history_prefix_search(True)
+            if not mode:
+                ln.history_prefix = None
+            # don't time a collection of the index
+            gc.collect()
+            results = []
+            for prefix in prefixes:
+                t0 = time.perf_counter()
+                matches = ln.history_prefix_matches(prefix, ln.history.seq(0) + 1)
+                next(matches, None)
+                t1 = time.perf_counter()
+                for _ in range(9):
+                    next(matches, None)
+                results.append((prefix, t1 - t0, time.perf_counter() - t1))
+                # the matches hold on to the history, don't time freeing it
+                del matches
+            t0 = time.perf_counter()
+            for l in lines[:100]:
+                ln.history_add(l + " again")
+            t_add = (time.perf_counter() - t0) / 100
+            print("  %7d lines %-7s add %6.3f ms" % (n, ("scan", "indexed")[mode], t_add * 1000.0))
+            for p, t0, t1 in results:
+                print("    %-21s first %8.3f next 9 %8.3f ms" % ("'%s'" % p, t0 * 1000.0, t1 * 1000.0))
+
+
+# -----------------------------------------------------------------------------
+# save: per command cost of saving the history
+
+_SAVE_SIZES = (1000, 10000, 100000)
+_SAVE_COMMANDS = 200
+
+
+def bench_save():
+    """history_add() + history_save() per command: full rewrite versus the append-only file"""
+    print("save: per command history save")
+    fname = "benchmark_history.txt"
+    for n in _SAVE_SIZES:
+        lines = history_lines(n + _SAVE_COMMANDS)
+        for mode in ("rewrite", "append-only", "shared"):
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(n)
+            if os.path.exists(fname):
+                os.unlink(fname)
+            for l in lines[:n]:
+                ln.history_add(l)
+            ln.history_save(fname)
+            if mode != "rewrite":
+                ln.history_open(fname, shared=(mode == "shared"))
+            t0 = time.perf_counter()
+            for l in lines[n:]:
+                ln.history_add(l)
+                ln.history_save(fname)
+            t = time.perf_counter() - t0
+            ln.history_close()
+            os.unlink(fname)
+            print(
+                "  %6d lines %-12s %8.3f ms/command" % (n, mode, t * 1000.0 / _SAVE_COMMANDS)
+            )
+
+
+# -----------------------------------------------------------------------------
+# load: time to load a large history file
+
+_LOAD_MB = 200
+_LOAD_MAXLEN = (1000, 100000)
+
+
+def bench_load():
+    """history_load(): read all lines versus the memory mapped file"""
+    fname = "benchmark_history.txt"
+    f = open(fname, "w")
+    lines = "\n".join(history_lines(100000)) + "\n"
+    while f.tell() < _LOAD_MB << 20:
+        f.write(lines)
+    f.close()
+    print("load: %d MB history file" % (os.path.getsize(fname) >> 20))
+    for n in _LOAD_MAXLEN:
+        for lazy in (False, True):
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(n)
+            t0 = time.perf_counter()
+            ln.history_load(fname, lazy)
+            t = time.perf_counter() - t0
+            assert len(ln.history) == n
+            # load again to measure the memory, tracing slows it down
+            ln.history_load(None)
+            tracemalloc.start()
+            ln.history_load(fname, lazy)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                "  maxlen %6d %-6s %8.2f ms python heap peak %8.2f MB"
+                % (n, ("eager", "lazy")[lazy], t * 1000.0, peak / (1 << 20))
+            )
+    os.unlink(fname)
+
+
+# -----------------------------------------------------------------------------
+# unique: cost of erasing older duplicates
+
+_UNIQUE_SIZES = (10000, 100000, 1000000)
+_UNIQUE_ADDS = 10000
+
+
+def bench_unique():
+    """re-adding history lines: list.remove() scan versus the hash indexed history"""
+    print("unique: re-adding existing history lines")
+    for n in _UNIQUE_SIZES:
+        lines = ["command %d" % i for i in range(n)]
+        adds = [lines[i * 7919 % n] for i in range(_UNIQUE_ADDS)]
+        # scan the history for the older copy
+        history = list(lines)
+        t0 = time.perf_counter()
+        for l in adds:
+            history.remove(l)
+            history.append(l)
+        t_scan = time.perf_counter() - t0
+        # hash indexed
+        ln = linenoise.linenoise()
+        ln.history_set_maxlen(n)
+        ln.set_history_unique(True)
+        for l in lines:
+            ln.history_add(l)
+        t0 = time.perf_counter()
+        for l in adds:
+            ln.history_add(l)
+        t_hash = time.perf_counter() - t0
+        assert list(ln.history_list()) == history
+        print(
+            "  %7d lines scan %8.2f us/add hashed %8.2f us/add"
+            % (n, t_scan * 1e6 / _UNIQUE_ADDS, t_hash * 1e6 / _UNIQUE_ADDS)
+        )
+
+
+# -----------------------------------------------------------------------------
+# frecent: cost of evicting the least frecent line
+
+_FRECENT_ADDS = 10000
+_FRECENT_SCANS = 20
+
+
+def bench_frecent():
+    """adding new lines to a full history: scanning for the least frecent line versus the heap"""
+    print("frecent: adding new lines to a full frecency ranked history")
+    for n in _UNIQUE_SIZES:
+        ln = linenoise.linenoise()
+        ln.history_set_maxlen(n)
+        ln.set_history_frecency(True)
+        for i in range(n):
+            ln.history_add("command %d" % (i % (n // 2)))
+        for i in range(n // 2):
+            ln.history_add("other %d" % i)
+        store = ln.history
+        # scan all lines for the least frecent one
+        now = time.time()
+        t0 = time.perf_counter()
+        for _ in range(_FRECENT_SCANS):
+            min(store.stats, key=lambda l: store.score(l, now))
+        t_scan = time.perf_counter() - t0
+        # heap of fixed keys
+        t0 = time.perf_counter()
+        for i in range(_FRECENT_ADDS):
+            ln.history_add("new %d" % i)
+        t_heap = time.perf_counter() - t0
+        assert len(store) == n
+        print(
+            "  %7d lines scan %10.2f us/add heap %8.2f us/add"
+            % (n, t_scan * 1e6 / _FRECENT_SCANS, t_heap * 1e6 / _FRECENT_ADDS)
+        )
+
+
+# -----------------------------------------------------------------------------
+# db: history database searches
+
+_DB_SIZES = (10000, 100000, 1000000)
+_DB_ADDS = 1000
+
+
+def bench_db():
+    """history database: history_add() cost, substring search with a scan versus the full-text index"""
+    print("db: history database, latest 100 matches of a rare and a common substring")
+    fname = "benchmark_history.db"
+    for n in _DB_SIZES:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(fname + suffix):
+                os.unlink(fname + suffix)
+        ln = linenoise.linenoise()
+        ln.history_open_db(fname)
+        db = ln.history_file
+        with db.db:
+            db.db.executemany(
+                "INSERT INTO history (line, time, session) VALUES (?, 0, 'benchmark')", ((l,) for l in history_lines(n))
+            )
+        t0 = time.perf_counter()
+        for i in range(_DB_ADDS):
+            ln.history_add("new command %d" % i)
+        t_add = time.perf_counter() - t0
+        times = []
+        for fts in (False, True):
+            db.fts = fts
+            for query in ("host23757.example", "example"):
+                t0 = time.perf_counter()
+                rows = ln.history_query(query)
+                times.append(time.perf_counter() - t0)
+                assert rows and query in rows[0][0]
+        print(
+            "  %7d lines add %6.3f ms scan %8.2f %8.2f ms fts %8.2f %8.2f ms"
+            % (n, t_add * 1000.0 / _DB_ADDS, *(t * 1000.0 for t in times))
+        )
+        ln.history_close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(fname + suffix):
+            os.unlink(fname + suffix)
+
+
+# -----------------------------------------------------------------------------
+# writer: history_add() latency with the background writer
+
+_WRITER_COMMANDS = 500
+
+
+def bench_writer():
+    """history_add() latency on the prompt path: synchronous writes versus the background writer"""
+    print("writer: history_add() latency, fsync per line")
+    for kind in ("file", "db"):
+        fname = "benchmark_history." + ("txt", "db")[kind == "db"]
+        for background in (False, True):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(fname + suffix):
+                    os.unlink(fname + suffix)
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(1000)
+            if kind == "file":
+                ln.history_open(fname, sync=1)
+            else:
+                ln.history_open_db(fname)
+                ln.history_file.db.execute("PRAGMA synchronous = FULL")
+            ln.set_history_writer(background, delay=0.01)
+            times = []
+            for l in history_lines(_WRITER_COMMANDS):
+                t0 = time.perf_counter()
+                ln.history_add(l)
+                times.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            ln.history_close()
+            t_close = time.perf_counter() - t0
+            times.sort()
+            print(
+                "  %-4s %-10s mean %8.3f ms p99 %8.3f ms max %8.3f ms close %8.2f ms"
+                % (
+                    kind,
+                    ("sync", "background")[background],
+                    sum(times) * 1000.0 / len(times),
+                    times[len(times) * 99 // 100] * 1000.0,
+                    times[-1] * 1000.0,
+                    t_close * 1000.0,
+                )
+            )
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(fname + suffix):
+                    os.unlink(fname + suffix)
+
+
+# -----------------------------------------------------------------------------
+# packed: memory used by large histories
+
+_PACKED_SIZES = (100000, 1000000)
+_PACKED_GETS = 100000
+
+
+def bench_packed():
+    """history memory: a list of strings versus the packed buffer"""
+    print("packed: history memory, add and get costs")
+    for n in _PACKED_SIZES:
+        lines = [l.encode("utf8") for l in history_lines(n)]
+        text = sum(len(l) for l in lines)
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.history_set_maxlen(n)
+            ln.set_history_packed(mode)
+            t0 = time.perf_counter()
+            for l in lines:
+                ln.history_add(l.decode("utf8"))
+            t_add = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for i in range(_PACKED_GETS):
+                ln.history_get(i * 7919 % n)
+            t_get = time.perf_counter() - t0
+            # add again to measure the memory, tracing slows it down
+            ln.history.clear()
+            gc.collect()
+            tracemalloc.start()
+            for l in lines:
+                ln.history_add(l.decode("utf8"))
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(
+                "  %7d lines (%5.1f MB text) %-6s %8.1f MB add %6.3f us get %6.3f us"
+                % (
+                    n,
+                    text / (1 << 20),
+                    ("list", "packed")[mode],
+                    size / (1 << 20),
+                    t_add * 1e6 / n,
+                    t_get * 1e6 / _PACKED_GETS,
+                )
+            )
+
+
+# -----------------------------------------------------------------------------
+# complete: key latency with a slow completion callback
+
+_COMPLETE_TIMES = (0.05, 0.2)
+
+
+def bench_complete():
+    """key latency with a slow completion callback: foreground versus background completion"""
+    print("complete: key latency, typing on after Tab")
+    keys = list("show ") + ["\t"] + list("interface") + ["\r"]
+    for t in _COMPLETE_TIMES:
+
+        def completion(line):
+            time.sleep(t)
+            return [line + "version", line + "ip route"]
+
+        for mode in (False, True):
+            ln = linenoise.linenoise()
+            ln.set_completion_callback(completion)
+            ln.set_completion_async(mode, 0.02)
+            handled = []
+            edit_key = ln.edit_key
+
+            def timed_edit_key(ls, key):
+                handled.append(time.perf_counter())
+                edit_key(ls, key)
+
+            ln.edit_key = timed_edit_key
+            session = pty_session(ln)
+            line = session.run(keys, delay=0.01)
+            assert line.startswith("show ")
+            latency = [h - s for (h, s) in zip(handled, session.sent)]
+            print(
+                "  callback %4d ms %-10s max key latency %8.2f ms"
+                % (t * 1000.0, ("foreground", "background")[mode], max(latency) * 1000.0)
+            )
+
+
+# -----------------------------------------------------------------------------
+# cache: completion callback calls while typing a command
+
+_CACHE_COMMANDS = 10000
+_CACHE_QUERY = 0.005  # 5 ms
+
+
+def bench_cache():
+    """Tab after every character: calling the completion callback versus the completion cache"""
+    print("cache: Tab after every character, callback with a %d ms query" % (_CACHE_QUERY * 1000))
+    commands = history_lines(_CACHE_COMMANDS)
+    typed = "traceroute host2375"
+    for mode in (False, True):
+        calls = [0]
+
+        def completion(line):
+            calls[0] += 1
+            time.sleep(_CACHE_QUERY)
+            return linenoise.monotonic_completions(c for c in commands if c.startswith(line))
+
+        ln = linenoise.linenoise()
+        ln.set_completion_callback(completion)
+        ln.set_completion_cache(mode)
+        t0 = time.perf_counter()
+        # type the line twice
+        for _ in range(2):
+            for i in range(1, len(typed) + 1):
+                lc = ln.completions(typed[:i])
+        t = time.perf_counter() - t0
+        assert all(c.startswith(typed) for c in lc)
+        print(
+            "  %-8s callback calls %4d %8.3f ms/Tab hits/narrowed/misses %s"
+            % (("none", "cache")[mode], calls[0], t * 1000.0 / (2 * len(typed)), ln.completion_stats())
+        )
+
+
+# -----------------------------------------------------------------------------
+# stream: completing over a huge candidate set
+
+_STREAM_SIZES = (50000, 500000)
+
+
+def bench_stream():
+    """Tab over a huge candidate set: a completion list versus a generator"""
+    print("stream: type, Tab twice, Enter")
+    for n in _STREAM_SIZES:
+        for mode in (False, True):
+
+            def completion(line):
+                names = ("%sbject-%07d" % (line, i) for i in range(n))
+                return names if mode else list(names)
+
+            ln = linenoise.linenoise()
+            ln.set_completion_callback(completion)
+            session = pty_session(ln)
+            line = session.run("o\t\t\r")
+            assert line == "object-0000001"
+            # again to measure the memory, tracing slows it down
+            gc.collect()
+            tracemalloc.start()
+            pty_session(ln).run("o\t\t\r")
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                "  %7d candidates %-9s edit() %8.2f ms python heap peak %8.2f MB"
+                % (n, ("list", "generator")[mode], session.elapsed * 1000.0, peak / (1 << 20))
+            )
+
+
+# -----------------------------------------------------------------------------
+# list: laying out completions in columns
+
+_LIST_SIZES = (1000, 10000, 100000)
+
+
+def bench_list():
+    """completion listing: layout time, and terminal output with the query and the pager"""
+    print("list: Tab listing the completions in 80x24")
+    for n in _LIST_SIZES:
+        items = ["object-%d" % (i * 7919 % (n * 10)) for i in range(n)]
+        t0 = time.perf_counter()
+        rows = linenoise.column_rows(items, 80)
+        t = time.perf_counter() - t0
+        full = sum(len(r) + 2 for r in rows)
+        ln = linenoise.linenoise()
+        ln.set_completion_callback(lambda line: iter(items))
+        ln.set_completion_list(True)
+        # the first Tab extends the line, the second lists: decline, then quit after the first page
+        output = []
+        for keys in ("o\t\tn\r", "o\t\tyq\r"):
+            session = pty_session(ln)
+            session.run(keys)
+            output.append(session.output)
+        print(
+            "  %7d completions layout %8.2f ms full listing %9d bytes declined %5d bytes first page %5d bytes"
+            % (n, t * 1000.0, full, *output)
+        )
+
+
+# -----------------------------------------------------------------------------
+# fuzzy: ranking a large completion set by fuzzy matching
+
+_FUZZY_SIZES = (10000, 100000, 1000000)
+_FUZZY_PATTERN = "trhex"
+
+
+def bench_fuzzy():
+    """fuzzy completion: Python scoring versus the process pool versus numpy"""
+    # the pool is used even on a single cpu, to show its overhead
+    workers = max(2, os.cpu_count() or 1)
+    print("fuzzy: rank the completions for %r, %d cpus" % (_FUZZY_PATTERN, os.cpu_count() or 1))
+    modes = [("python", {"parallel": 0}), ("pool", {"workers": workers, "parallel": 1})]
+    try:
+        import numpy  # noqa: F401
+
+        modes.append(("numpy", {"parallel": 0, "vectorize": True}))
+        modes.append(("pool+numpy", {"workers": workers, "parallel": 1, "vectorize": True}))
+    except ImportError:
+        print("  numpy is not installed")
+    for n in _FUZZY_SIZES:
+        names = [l.replace(" ", "-") for l in history_lines(n)]
+        for name, kwargs in modes:
+            fm = linenoise.fuzzy_matcher(lambda line: names, **kwargs)
+            # the first call starts the pool
+            lc = fm(_FUZZY_PATTERN)
+            times = []
+            for _ in range(3):
+                t0 = time.perf_counter()
+                fm(_FUZZY_PATTERN)
+                times.append(time.perf_counter() - t0)
+            fm.close()
+            t = min(times)
+            assert lc[0].startswith("traceroute-host")
+            print(
+                "  %7d candidates %-10s %6d matches latency %9.2f ms %9.0f matches/s %9.0f candidates/s"
+                % (n, name, len(lc), t * 1000.0, len(lc) / t, n / t)
+            )
+
+
+# -----------------------------------------------------------------------------
+
+benchmarks = {
+    "input": bench_input,
+    "paste": bench_paste,
+    "render": bench_render,
+    "search": bench_search,
+    "prefix": bench_prefix,
+    "save": bench_save,
+    "load": bench_load,
+    "unique": bench_unique,
+    "frecent": bench_frecent,
+    "db": bench_db,
+    "writer": bench_writer,
+    "packed": bench_packed,
+    "complete": bench_complete,
+    "cache": bench_cache,
+    "stream": bench_stream,
+    "list": bench_list,
+    "fuzzy": bench_fuzzy,
+}
+
+
+def main():
+    names = sys.argv[1:]
+    for name in names:
+        if name not in benchmarks:
+            sys.stderr.write("Usage: %s [%s]\n" % (sys.argv[0], "|".join(benchmarks)))
+            sys.exit(1)
+    for name in names or benchmarks:
+        benchmarks[name]()
+    sys.exit(0)
+
+
+# process pool workers may import this module
+if __name__ == "__main__":
+    main()
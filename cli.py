@@ -85,7 +85,11 @@ class cli:
         self.ui = ui
         self.ln = linenoise.linenoise()
         self.ln.set_completion_callback(self.completion_callback)
-        self.ln.set_hotkey("?")
+        # cli key bindings overlay the linenoise key bindings
+        self.keymap = linenoise.keymap(self.ln.keymap)
+        self.ln.set_keymap(self.keymap)
+        # '?' exits line editing for context sensitive help
+        self.bind_key("?", linenoise.action_hotkey)
         self.ln.history_load(history)
         self.poll = None
         self.root = None
@@ -104,6 +108,23 @@ class cli:
         """set the external polling function"""
         self.poll = poll
 
+    def set_fuzzy(self, mode, **kwargs):
+        """
+        set fuzzy completion: tab completes the last command by fuzzy matching (Eg. show ifc = show interfaces)
+        kwargs are passed to linenoise.fuzzy_matcher()
+        """
+        fn = self.completion_callback
+        if mode:
+            fn = linenoise.fuzzy_matcher(fn, **kwargs)
+        self.ln.set_completion_callback(fn)
+
+    def bind_key(self, key, fn):
+        """
+        bind a key event to a line editing action: fn(ls, key)
+        ls is the linenoise line state, so the action can look at the current command line.
+        """
+        self.keymap.bind(key, fn)
+
     def display_error(self, msg, cmds, idx):
         """display a parse error string"""
         marker = []
@@ -74,8 +74,9 @@ def main():
     ln.set_hints_callback(hints)
 
     # Load history from file. The history file is a plain text file
-    # where entries are separated by newlines.
-    ln.history_load("history.txt")
+    # where entries are separated by newlines. The file is kept open
+    # and each new history entry is appended to it.
+    ln.history_open("history.txt")
 
     # Set a hotkey. A hotkey will cause the line editing to exit. The hotkey
     # will be appended to the returned line buffer but not displayed.
@@ -103,7 +104,6 @@ def main():
             if line.endswith(_KEY_HOTKEY):
                 line = line[:-1]
             ln.history_add(line)
-            ln.history_save("history.txt")
 
     sys.exit(0)
 
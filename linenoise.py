@@ -11,16 +11,38 @@ Based on: http://github.com/antirez/linenoise
 # -----------------------------------------------------------------------------
 
 import os
+import re
 import stat
 import sys
+import time
 import select
 import atexit
 import termios
 import struct
 import fcntl
+import signal
+import array
+import bisect
+import mmap
+import math
+import heapq
+import itertools
 import string
+import operator
+import codecs
+import tempfile
+import threading
+import collections
+import concurrent.futures
+import multiprocessing
 import logging
 
+try:
+    import sqlite3
+except ImportError:
+    # Python can be built without sqlite
+    sqlite3 = None
+
 # -----------------------------------------------------------------------------
 # logging
 
@@ -40,6 +62,7 @@ _KEY_CTRL_C = chr(3)
 _KEY_CTRL_D = chr(4)
 _KEY_CTRL_E = chr(5)
 _KEY_CTRL_F = chr(6)
+_KEY_CTRL_G = chr(7)
 _KEY_CTRL_H = chr(8)
 _KEY_TAB = chr(9)
 _KEY_CTRL_K = chr(11)
@@ -47,12 +70,30 @@ _KEY_CTRL_L = chr(12)
 _KEY_ENTER = chr(13)
 _KEY_CTRL_N = chr(14)
 _KEY_CTRL_P = chr(16)
+_KEY_CTRL_R = chr(18)
 _KEY_CTRL_T = chr(20)
 _KEY_CTRL_U = chr(21)
 _KEY_CTRL_W = chr(23)
 _KEY_ESC = chr(27)
 _KEY_BS = chr(127)
 
+# Key Events
+# Escape sequences are decoded to named key events. Names never clash with
+# the single character key codes. Modifiers are prefixed: "C-left", "M-b", "C-S-up"
+_KEY_UP = "up"
+_KEY_DOWN = "down"
+_KEY_RIGHT = "right"
+_KEY_LEFT = "left"
+_KEY_HOME = "home"
+_KEY_END = "end"
+_KEY_INSERT = "insert"
+_KEY_DELETE = "delete"
+_KEY_PAGE_UP = "page-up"
+_KEY_PAGE_DOWN = "page-down"
+_KEY_SHIFT_TAB = "S-tab"
+_KEY_PASTE = "paste"  # start of bracketed paste text
+_KEY_RESIZE = "resize"  # the terminal has been resized
+
 # -----------------------------------------------------------------------------
 
 _STDIN = sys.stdin.fileno()
@@ -60,6 +101,26 @@ _STDOUT = sys.stdout.fileno()
 _STDERR = sys.stderr.fileno()
 
 _CHAR_TIMEOUT = 0.02  # 20 ms
+_PASTE_TIMEOUT = 1.0  # 1 s
+_COMPLETION_DEADLINE = 0.1  # 100 ms
+_COMPLETION_POLL = 0.005  # 5 ms
+_COMPLETION_TTL = 60.0  # 1 minute
+_COMPLETION_BUFFER = 1024  # completions buffered from an iterator
+
+# shown after the line while background completions are pending
+_COMPLETION_PENDING = " [completing...]"
+
+# fuzzy matching scores
+_FUZZY_MATCH = 16  # each matched character
+_FUZZY_BOUNDARY = 8  # a match at the start of a word
+_FUZZY_CONSECUTIVE = 4  # a match right after the previous match
+_FUZZY_GAP = 1  # each character skipped between matches
+_FUZZY_SEPARATORS = " -_./:,;=@"  # a character after these starts a word
+_FUZZY_PARALLEL = 100000  # completions scored on the process pool
+_FUZZY_BLOCK = 65536  # completions scored by numpy at once
+
+# greater than any character that follows a prefix
+_MAX_CHAR = chr(0x10FFFF)
 
 
 def _getc(fd, timeout=-1):
@@ -91,57 +152,321 @@ def would_block(fd, timeout):
     return len(rd) == 0
 
 
+# -----------------------------------------------------------------------------
+
+# maximum number of bytes taken from the input with a single read
+_READ_SIZE = 65536
+
+
+class input_stream:
+    """
+    buffered input from a file descriptor
+    Everything the file descriptor has available is read with a single os.read()
+    and handed out a character at a time. A paste costs a couple of syscalls in
+    total rather than a couple of syscalls per byte.
+    The input is utf8 decoded incrementally, so a multi-byte character split across
+    reads comes out whole, and invalid input decodes as U+FFFD rather than raising.
+    """
+
+    def __init__(self, fd, wakeup=None):
+        self.fd = fd  # input file descriptor
+        self.wakeup = wakeup  # readable when the terminal has been resized (or None)
+        self.resized = False  # has the terminal been resized?
+        self.decoder = codecs.getincrementaldecoder("utf8")("replace")  # utf8 decoder state
+        self.buf = ""  # pending input characters
+        self.idx = 0  # index of the next pending character
+
+    def pending(self):
+        """return True if there is buffered input"""
+        return self.idx < len(self.buf)
+
+    def fill(self, timeout=-1):
+        """
+        read all of the currently available input into the buffer (with timeout)
+        timeout = 0 : return immediately
+        timeout < 0 : wait for input (block)
+        timeout > 0 : wait for timeout seconds
+        return True if there is buffered input
+        A terminal resize stops the wait and sets self.resized.
+        """
+        while not self.pending():
+            if self.wakeup is not None:
+                (rd, _, _) = select.select((self.fd, self.wakeup), (), (), (None, timeout)[timeout >= 0])
+                if self.wakeup in rd:
+                    try:
+                        os.read(self.wakeup, 64)
+                    except BlockingIOError:
+                        pass
+                    self.resized = True
+                    return False
+                if len(rd) == 0:
+                    return False
+            elif timeout >= 0 and would_block(self.fd, timeout):
+                return False
+            data = os.read(self.fd, _READ_SIZE)
+            # decode the whole block in one go, a trailing partial character is held by the decoder
+            self.buf = self.decoder.decode(data, len(data) == 0)
+            self.idx = 0
+            if len(data) == 0:
+                # end of file
+                break
+        return self.pending()
+
+    def would_block(self, timeout):
+        """if no input is available within timeout seconds - return True"""
+        return not self.fill(timeout)
+
+    def read_until(self, end, timeout=-1):
+        """
+        read a string up to (and consuming) an end marker
+        Return the string read so far if the input times out or reaches end of file.
+        """
+        data = self.buf[self.idx :]
+        self.buf = ""
+        self.idx = 0
+        start = 0
+        while True:
+            i = data.find(end, start)
+            if i >= 0:
+                # push back anything after the end marker
+                self.buf = data[i + len(end) :]
+                return data[:i]
+            # the end marker may straddle the next read
+            start = max(0, len(data) - len(end) + 1)
+            if timeout >= 0 and would_block(self.fd, timeout):
+                return data
+            block = os.read(self.fd, _READ_SIZE)
+            data += self.decoder.decode(block, len(block) == 0)
+            if len(block) == 0:
+                return data
+
+    def read_reply(self, pattern, timeout):
+        """
+        read a terminal reply matching a compiled regex, return the match (None on timeout)
+        The reply is taken out of the input, any keys typed around it stay buffered.
+        """
+        data = self.buf[self.idx :]
+        while True:
+            m = pattern.search(data)
+            if m is not None:
+                data = data[: m.start()] + data[m.end() :]
+                break
+            if would_block(self.fd, timeout):
+                break
+            block = os.read(self.fd, _READ_SIZE)
+            data += self.decoder.decode(block, len(block) == 0)
+            if len(block) == 0:
+                break
+        self.buf = data
+        self.idx = 0
+        return m
+
+    def getc(self, timeout=-1):
+        """read a single character string (with timeout), _KEY_NULL if there is none"""
+        if not self.fill(timeout):
+            return _KEY_NULL
+        c = self.buf[self.idx]
+        self.idx += 1
+        return c
+
+
+# -----------------------------------------------------------------------------
+# key decoding
+
+# escape sequences and their key events
+_ESC_SEQUENCES = (
+    # CSI: ESC [ final
+    ("\x1b[A", _KEY_UP),
+    ("\x1b[B", _KEY_DOWN),
+    ("\x1b[C", _KEY_RIGHT),
+    ("\x1b[D", _KEY_LEFT),
+    ("\x1b[H", _KEY_HOME),
+    ("\x1b[F", _KEY_END),
+    ("\x1b[Z", _KEY_SHIFT_TAB),
+    ("\x1b[P", "f1"),
+    ("\x1b[Q", "f2"),
+    ("\x1b[R", "f3"),
+    ("\x1b[S", "f4"),
+    # CSI: ESC [ number ~
+    ("\x1b[1~", _KEY_HOME),
+    ("\x1b[2~", _KEY_INSERT),
+    ("\x1b[3~", _KEY_DELETE),
+    ("\x1b[4~", _KEY_END),
+    ("\x1b[5~", _KEY_PAGE_UP),
+    ("\x1b[6~", _KEY_PAGE_DOWN),
+    ("\x1b[7~", _KEY_HOME),
+    ("\x1b[8~", _KEY_END),
+    ("\x1b[11~", "f1"),
+    ("\x1b[12~", "f2"),
+    ("\x1b[13~", "f3"),
+    ("\x1b[14~", "f4"),
+    ("\x1b[15~", "f5"),
+    ("\x1b[17~", "f6"),
+    ("\x1b[18~", "f7"),
+    ("\x1b[19~", "f8"),
+    ("\x1b[20~", "f9"),
+    ("\x1b[21~", "f10"),
+    ("\x1b[23~", "f11"),
+    ("\x1b[24~", "f12"),
+    ("\x1b[200~", _KEY_PASTE),
+    # SS3: ESC O final
+    ("\x1bOA", _KEY_UP),
+    ("\x1bOB", _KEY_DOWN),
+    ("\x1bOC", _KEY_RIGHT),
+    ("\x1bOD", _KEY_LEFT),
+    ("\x1bOH", _KEY_HOME),
+    ("\x1bOF", _KEY_END),
+    ("\x1bOP", "f1"),
+    ("\x1bOQ", "f2"),
+    ("\x1bOR", "f3"),
+    ("\x1bOS", "f4"),
+)
+
+_CSI = "\x1b["
+
+# xterm modifier parameter - 1 = bitmap of modifiers
+_MODIFIERS = ("", "S-", "M-", "M-S-", "C-", "C-S-", "C-M-", "C-M-S-")
+
+
+def _csi_parameter(c):
+    """return True for a CSI parameter or intermediate byte"""
+    return "\x20" <= c <= "\x3f"
+
+
+class key_decoder:
+    """
+    decode the input stream into key events
+    The escape sequences are compiled into a trie, so decoding a key costs one step per character.
+    CSI sequences with parameters (Eg. ESC [ 1 ; 5 C = C-right) are parsed by a small
+    state machine and mapped back onto the trie. Escape followed by any other key is Alt-key.
+    We only wait for more input when a sequence is incomplete and nothing else is buffered.
+    """
+
+    def __init__(self, sequences=_ESC_SEQUENCES):
+        self.table = {}  # escape sequence to key event
+        self.trie = {}  # compiled escape sequences: char to node, None to key event
+        self.raw = ""  # the characters of the last key event
+        for seq, key in sequences:
+            self.add_sequence(seq, key)
+
+    def add_sequence(self, seq, key):
+        """add an escape sequence for a key event"""
+        self.table[seq] = key
+        node = self.trie
+        for c in seq:
+            node = node.setdefault(c, {})
+        node[None] = key
+
+    def get_csi(self, inp, seq):
+        """parse a CSI sequence with parameters, return the key event"""
+        # read the parameters up to the final byte
+        c = seq[-1]
+        while _csi_parameter(c) and len(seq) < 32:
+            c = inp.getc(_CHAR_TIMEOUT)
+            if c == _KEY_NULL:
+                # truncated sequence
+                return seq
+            seq += c
+        self.raw = seq
+        params = seq[len(_CSI) : -1].split(";")
+        # the first parameter is part of the key for ESC [ n ~, else it's a default 1
+        if c == "~":
+            key = self.table.get(_CSI + params[0] + c)
+        elif params[0] in ("", "1"):
+            key = self.table.get(_CSI + c)
+        else:
+            key = None
+        if key is None:
+            # unknown sequence
+            return seq
+        # modifiers
+        if len(params) > 1 and params[1].isdigit():
+            key = _MODIFIERS[(int(params[1]) - 1) & 7] + key
+        return key
+
+    def get_key(self, inp, timeout=-1):
+        """
+        read the next key event from an input stream (with timeout)
+        return _KEY_NULL if there is none
+        """
+        if not inp.resized:
+            c = inp.getc(timeout)
+        if inp.resized:
+            inp.resized = False
+            self.raw = ""
+            return _KEY_RESIZE
+        self.raw = c
+        if c != _KEY_ESC:
+            return c
+        node = self.trie[_KEY_ESC]
+        seq = c
+        while True:
+            # returns immediately if the rest of the sequence is buffered
+            c = inp.getc(_CHAR_TIMEOUT)
+            if c == _KEY_NULL:
+                if len(seq) == 2:
+                    # a lone ESC [ or ESC O is Alt-[ or Alt-O
+                    return "M-" + seq[1]
+                # a lone escape, or a truncated sequence
+                return node.get(None, seq)
+            if seq == _CSI and _csi_parameter(c):
+                return self.get_csi(inp, seq + c)
+            self.raw = seq + c
+            if c not in node:
+                if seq == _KEY_ESC:
+                    # escape prefixed key
+                    return "M-" + c
+                # unknown sequence
+                return self.raw
+            seq += c
+            node = node[c]
+            if len(node) == 1 and None in node:
+                # a complete sequence
+                return node[None]
+
+
 # -----------------------------------------------------------------------------
 
 # Use this value if we can't work out how many columns the terminal has.
 _DEFAULT_COLS = 80
+_DEFAULT_ROWS = 24
+
 
+# the terminal's reply to a cursor position query: ESC [ rows ; cols R
+_CURSOR_POSITION = re.compile("\x1b\\[([0-9]+);([0-9]+)R")
 
-def get_cursor_position(ifd, ofd):
-    """Get the horizontal cursor position"""
+
+def get_cursor_position(inp, ofd):
+    """Get the horizontal cursor position, keys typed meanwhile stay in the input stream"""
     # query the cursor location
     if _puts(ofd, "\x1b[6n") != 4:
         return -1
-    # read the response: ESC [ rows ; cols R
-    # rows/cols are decimal number strings
-    buf = []
-    while len(buf) < 32:
-        c = _getc(ifd, _CHAR_TIMEOUT)
-        if c == _KEY_NULL:
-            break
-        buf.append(c)
-        if buf[-1] == "R":
-            break
-    # parse it: esc [ number ; number R (at least 6 characters)
-    if len(buf) < 6 or buf[0] != _KEY_ESC or buf[1] != "[" or buf[-1] != "R":
-        return -1
-    # should have 2 number fields
-    x = "".join(buf[2:-1]).split(";")
-    if len(x) != 2:
+    # read the response
+    m = inp.read_reply(_CURSOR_POSITION, _CHAR_TIMEOUT)
+    if m is None:
         return -1
-    (_, cols) = x
     # return the cols
-    return int(cols, 10)
+    return int(m.group(2), 10)
 
 
-def get_columns(ifd, ofd):
-    """Get the number of columns for the terminal. Assume _DEFAULT_COLS if it fails."""
+def query_columns(inp, ofd):
+    """Ask the terminal for its number of columns. Assume _DEFAULT_COLS if it fails."""
     cols = 0
     # try using the ioctl to get the number of cols
     try:
-        t = fcntl.ioctl(_STDOUT, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0))
+        t = fcntl.ioctl(ofd, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0))
         (_, cols, _, _) = struct.unpack("HHHH", t)
     except:
         pass
     if cols == 0:
         # the ioctl failed - try using the terminal itself
-        start = get_cursor_position(ifd, ofd)
+        start = get_cursor_position(inp, ofd)
         if start < 0:
             return _DEFAULT_COLS
         # Go to right margin and get position
         if _puts(ofd, "\x1b[999C") != 6:
             return _DEFAULT_COLS
-        cols = get_cursor_position(ifd, ofd)
+        cols = get_cursor_position(inp, ofd)
         if cols < 0:
             return _DEFAULT_COLS
         # restore the position
@@ -150,9 +475,104 @@ def get_columns(ifd, ofd):
     return cols
 
 
+# number of terminal columns, keyed by output file descriptor
+_columns = {}
+
+
+def get_columns(inp, ofd):
+    """
+    Get the number of columns for the terminal.
+    The result is cached when we have a SIGWINCH handler to tell us about resizes.
+    """
+    cols = _columns.get(ofd)
+    if cols is None:
+        cols = query_columns(inp, ofd)
+        if _resize_fd is not None:
+            _columns[ofd] = cols
+    return cols
+
+
+def query_rows(ofd):
+    """Ask the terminal for its number of rows. Assume _DEFAULT_ROWS if it fails."""
+    rows = 0
+    try:
+        t = fcntl.ioctl(ofd, termios.TIOCGWINSZ, struct.pack("HHHH", 0, 0, 0, 0))
+        (rows, _, _, _) = struct.unpack("HHHH", t)
+    except OSError:
+        pass
+    return rows or _DEFAULT_ROWS
+
+
+# -----------------------------------------------------------------------------
+# terminal resizing
+
+_resize_fd = None  # pipe read end, readable after a resize
+_resize_wfd = None  # pipe write end, written by the SIGWINCH handler
+_resize_chain = None  # the previous SIGWINCH handler
+
+
+def _sigwinch(signum, frame):
+    """SIGWINCH handler: the terminal has been resized"""
+    _columns.clear()
+    try:
+        os.write(_resize_wfd, b"w")
+    except OSError:
+        # the pipe is full, the wakeup is pending anyway
+        pass
+    if callable(_resize_chain):
+        _resize_chain(signum, frame)
+
+
+def watch_resize():
+    """
+    Install a SIGWINCH handler to track terminal resizes.
+    Return a file descriptor that becomes readable after a resize, or None if we can't do it.
+    """
+    global _resize_fd, _resize_wfd, _resize_chain
+    if _resize_fd is None and hasattr(signal, "SIGWINCH"):
+        (rfd, wfd) = os.pipe()
+        os.set_blocking(rfd, False)
+        os.set_blocking(wfd, False)
+        _resize_wfd = wfd
+        try:
+            _resize_chain = signal.signal(signal.SIGWINCH, _sigwinch)
+        except ValueError:
+            # signal handlers can only be set from the main thread
+            os.close(rfd)
+            os.close(wfd)
+            _resize_wfd = None
+            return None
+        _resize_fd = rfd
+    return _resize_fd
+
+
 # -----------------------------------------------------------------------------
 
 
+def _styled(s, style):
+    """return the output sequence for a string with a style"""
+    if len(s) == 0:
+        return []
+    if style:
+        return [style, s, "\033[0m"]
+    return [s]
+
+
+def _cursor_move(frm, to):
+    """return the shortest sequence to move the cursor horizontally, frm < 0 for unknown"""
+    if to == frm:
+        return ""
+    if to == 0:
+        return "\r"
+    if frm < 0:
+        return "\r\x1b[%dC" % to
+    if to < frm:
+        n = frm - to
+        return ("\b" * n, "\x1b[%dD" % n)[n > 3]
+    n = to - frm
+    return ("\x1b[C", "\x1b[%dC" % n)[n > 1]
+
+
 def clear_screen():
     """Clear the screen"""
     sys.stdout.write("\x1b[H\x1b[2J")
@@ -178,6 +598,420 @@ def unsupported_term():
 # -----------------------------------------------------------------------------
 
 
+class line_buffer:
+    """
+    gap buffer for the line being edited
+    The characters before the gap are kept in order, the characters after it in reverse
+    order. Insertion and deletion at the gap are O(1) amortised and the gap follows the
+    edit position. The string for the buffer is cached until the next change.
+    """
+
+    def __init__(self, s=""):
+        self.head = list(s)  # characters before the gap
+        self.tail = []  # characters after the gap, reversed
+        self.text = s  # cached string, None after a change
+
+    def move_gap(self, pos):
+        """move the gap to a position in the buffer"""
+        n = pos - len(self.head)
+        if n > 0:
+            chunk = self.tail[-n:]
+            del self.tail[-n:]
+            chunk.reverse()
+            self.head.extend(chunk)
+        elif n < 0:
+            chunk = self.head[n:]
+            del self.head[n:]
+            chunk.reverse()
+            self.tail.extend(chunk)
+
+    def insert(self, pos, s):
+        """insert a string at a position"""
+        self.move_gap(pos)
+        self.head.extend(s)
+        self.text = None
+
+    def delete(self, start, end):
+        """delete the characters from start up to end"""
+        if start < end:
+            self.move_gap(end)
+            del self.head[start:]
+            self.text = None
+
+    def replace(self, start, end, s):
+        """replace the characters from start up to end with a string"""
+        self.delete(start, end)
+        self.insert(start, s)
+
+    def set(self, s):
+        """set the buffer to a string"""
+        self.head = list(s)
+        self.tail = []
+        self.text = s
+
+    def __len__(self):
+        return len(self.head) + len(self.tail)
+
+    def __getitem__(self, i):
+        """return the character at an index, or the string for a slice"""
+        if isinstance(i, slice):
+            if self.text is not None:
+                return self.text[i]
+            (start, end, _) = i.indices(len(self))
+            h = len(self.head)
+            t = len(self.tail)
+            s = "".join(self.head[start : min(end, h)])
+            if end > h:
+                s += "".join(reversed(self.tail[t - (end - h) : t - max(0, start - h)]))
+            return s
+        if i < 0:
+            i += len(self)
+        if i < len(self.head):
+            return self.head[i]
+        return self.tail[len(self.head) + len(self.tail) - 1 - i]
+
+    def __str__(self):
+        if self.text is None:
+            self.text = "".join(self.head) + "".join(reversed(self.tail))
+        return self.text
+
+
+class completion_task:
+    """
+    the completion callback running on a worker thread
+    Python can't stop a thread, so a task that is no longer wanted runs to the end
+    and its result is dropped.
+    """
+
+    def __init__(self, fn, line):
+        self.line = line  # the line being completed
+        self.result = None  # the line completions
+        self.error = None  # exception raised by the callback
+        self.done = threading.Event()
+        threading.Thread(target=self.run, args=(fn,), name="completion", daemon=True).start()
+
+    def run(self, fn):
+        """call the completion callback"""
+        try:
+            self.result = fn(self.line)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+
+class monotonic_completions(list):
+    """
+    line completions marked as monotonic by the completion callback
+    The completions of any longer line starting with this line are just those of these
+    completions that start with it, so the completion cache can narrow them down.
+    """
+
+
+class completion_cache:
+    """
+    completions cache keyed by the line, with LRU eviction and a time to live
+    A line extending a cached line with monotonic completions gets those completions
+    filtered down rather than calling the completion callback again.
+    """
+
+    def __init__(self, maxsize=128, ttl=_COMPLETION_TTL):
+        self.maxsize = maxsize  # maximum number of cached lines
+        self.ttl = ttl  # seconds a result stays valid, 0 for no limit
+        self.entries = collections.OrderedDict()  # line to (time, completions), least recently used first
+        self.lock = threading.Lock()  # completions may run on worker threads
+        self.hits = 0  # lines found in the cache
+        self.narrowed = 0  # lines completed by narrowing down a shorter line
+        self.misses = 0  # lines completed by the callback
+
+    def lookup(self, line, now):
+        """return the live completions cached for a line, or None (lock first)"""
+        e = self.entries.get(line)
+        if e is None:
+            return None
+        if self.ttl and now - e[0] > self.ttl:
+            del self.entries[line]
+            return None
+        self.entries.move_to_end(line)
+        return e[1]
+
+    def get(self, line):
+        """return the completions for a line, None if they aren't cached"""
+        now = time.monotonic()
+        with self.lock:
+            lc = self.lookup(line, now)
+            if lc is not None:
+                self.hits += 1
+                return lc
+            # the longest shorter line with monotonic completions
+            for n in range(len(line) - 1, -1, -1):
+                lc = self.lookup(line[:n], now)
+                if isinstance(lc, monotonic_completions):
+                    lc = monotonic_completions(c for c in lc if c.startswith(line))
+                    self.narrowed += 1
+                    self.insert(line, lc, now)
+                    return lc
+            self.misses += 1
+            return None
+
+    def put(self, line, lc):
+        """cache the completions for a line"""
+        with self.lock:
+            self.insert(line, lc, time.monotonic())
+
+    def insert(self, line, lc, now):
+        """cache the completions for a line, evict the least recently used line (lock first)"""
+        self.entries[line] = (now, lc)
+        self.entries.move_to_end(line)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """remove all cached completions"""
+        with self.lock:
+            self.entries.clear()
+
+
+class completion_stream:
+    """
+    line completions pulled from the callback result as they are needed
+    The result can be any iterable, so a generator shows its first completion without
+    producing the rest. Up to maxbuf completions are buffered. Going back to a completion
+    that has been dropped from the buffer calls the callback again.
+    """
+
+    def __init__(self, fn, line, lc, maxbuf=_COMPLETION_BUFFER):
+        self.fn = fn  # completions function, to restart the completions
+        self.line = line  # the line being completed
+        self.it = iter(() if lc is None else lc)  # the completions not yet pulled, None when they are used up
+        self.buf = collections.deque(maxlen=maxbuf)  # the buffered completions
+        self.base = 0  # index of the oldest buffered completion
+        self.total = None  # number of completions, when it's known
+
+    def restart(self):
+        """start again from the first completion"""
+        lc = self.fn(self.line)
+        self.it = iter(() if lc is None else lc)
+        self.buf.clear()
+        self.base = 0
+
+    def get(self, idx):
+        """return a completion by index, None past the last completion"""
+        if idx < self.base:
+            self.restart()
+        while idx >= self.base + len(self.buf):
+            if self.total is not None and idx >= self.total:
+                return None
+            if self.it is None:
+                # count() has used up the completions
+                self.restart()
+                continue
+            c = next(self.it, None)
+            if c is None:
+                self.total = self.base + len(self.buf)
+                self.it = None
+                return None
+            if len(self.buf) == self.buf.maxlen:
+                self.base += 1
+            self.buf.append(c)
+        return self.buf[idx - self.base]
+
+    def count(self):
+        """return the number of completions, counting the rest without buffering them"""
+        if self.total is None:
+            self.total = self.base + len(self.buf) + sum(1 for _ in self.it)
+            self.it = None
+        return self.total
+
+
+def column_rows(items, cols, margin=2):
+    """
+    return the rows of a listing of the items in columns, down then across as ls does
+    The column width is found in one pass over the items, as for util.display_cols().
+    """
+    if len(items) == 0:
+        return []
+    width = max(len(s) for s in items) + margin
+    ncols = max(1, (cols + margin) // width)
+    nrows = (len(items) + ncols - 1) // ncols
+    fmt = "%%-%ds" % width
+    rows = []
+    for r in range(nrows):
+        row = items[r::nrows]
+        rows.append("".join([fmt % s for s in row[:-1]] + [row[-1]]))
+    return rows
+
+
+def fuzzy_score(pattern, s):
+    """
+    return the fzf style score of a string for a pattern, None if the pattern isn't a subsequence of it
+    Each character of the pattern matches the next occurrence in the string. Matches at the start
+    of a word (after a separator or a camelCase hump) and consecutive matches score higher, gaps
+    between matches score lower. A lower case pattern matches either case.
+    """
+    t = s.lower() if pattern.islower() else s
+    if len(t) != len(s):
+        s = t
+    score = 0
+    pos = -1
+    for c in pattern:
+        i = t.find(c, pos + 1)
+        if i < 0:
+            return None
+        score += _FUZZY_MATCH
+        if i == 0 or s[i - 1] in _FUZZY_SEPARATORS or ("a" <= s[i - 1] <= "z" and "A" <= s[i] <= "Z"):
+            score += _FUZZY_BOUNDARY
+        if pos >= 0:
+            score += _FUZZY_CONSECUTIVE if i == pos + 1 else -_FUZZY_GAP * (i - pos - 1)
+        pos = i
+    return score
+
+
+def _fuzzy_numpy(pattern, candidates):
+    """fuzzy_score() the candidates with numpy, return the (index, score) of the matches"""
+    # numpy is optional and slow to import, so it's imported when it's used
+    import numpy
+
+    try:
+        # one byte per character when the candidates are ASCII
+        s = numpy.array(candidates, dtype=bytes)
+        dtype = numpy.uint8
+        if max(map(ord, pattern), default=0) > 127:
+            return []
+    except UnicodeEncodeError:
+        s = numpy.array(candidates, dtype=str)
+        dtype = numpy.uint32
+    width = s.dtype.itemsize // numpy.dtype(dtype).itemsize
+    if width == 0:
+        return []
+    # the candidates as rows of code points, zero padded
+    orig = s.view(dtype).reshape(len(candidates), width)
+    codes = orig
+    if pattern.islower():
+        if dtype is numpy.uint8:
+            codes = orig + 32 * ((orig >= 65) & (orig <= 90)).astype(dtype)
+        else:
+            codes = numpy.char.lower(s).astype(s.dtype).view(dtype).reshape(orig.shape)
+    seps = numpy.array([ord(c) for c in _FUZZY_SEPARATORS], dtype=dtype)
+    cols = numpy.arange(width)
+    idx = numpy.arange(len(candidates))
+    score = numpy.zeros(len(candidates), dtype=numpy.int64)
+    pos = numpy.full(len(candidates), -1)
+    for c in pattern:
+        # the next occurrence of c in each candidate
+        m = (codes == ord(c)) & (cols > pos[:, None])
+        found = m.any(axis=1)
+        if not found.all():
+            # drop the candidates that don't match
+            idx, orig, codes, score, pos, m = idx[found], orig[found], codes[found], score[found], pos[found], m[found]
+        i = m.argmax(axis=1)
+        # a match at the start of a word
+        cur = numpy.take_along_axis(orig, i[:, None], axis=1)[:, 0]
+        prev = numpy.take_along_axis(orig, numpy.maximum(i - 1, 0)[:, None], axis=1)[:, 0]
+        camel = (prev >= 97) & (prev <= 122) & (cur >= 65) & (cur <= 90)
+        score += _FUZZY_MATCH + _FUZZY_BOUNDARY * ((i == 0) | numpy.isin(prev, seps) | camel)
+        gap = i - pos - 1
+        score += numpy.where(pos < 0, 0, numpy.where(gap == 0, _FUZZY_CONSECUTIVE, -_FUZZY_GAP * gap))
+        pos = i
+    return list(zip(idx.tolist(), score.tolist()))
+
+
+def fuzzy_scores(pattern, candidates, vectorize=False):
+    """
+    return the (index, score) of the candidates matching the pattern
+    vectorize: score with numpy, in blocks to bound the memory used
+    """
+    if vectorize:
+        matches = []
+        for k in range(0, len(candidates), _FUZZY_BLOCK):
+            matches.extend((k + i, score) for i, score in _fuzzy_numpy(pattern, candidates[k : k + _FUZZY_BLOCK]))
+        return matches
+    # reject the candidates the pattern isn't a subsequence of before scoring them
+    lower = pattern.islower()
+    subsequence = re.compile("".join("[^%s]*%s" % (e, e) for e in map(re.escape, pattern))).match
+    matches = []
+    for i, c in enumerate(candidates):
+        if subsequence(c.lower() if lower else c) is not None:
+            matches.append((i, fuzzy_score(pattern, c)))
+    return matches
+
+
+class fuzzy_matcher:
+    """
+    fuzzy completion: wraps a completion callback and ranks its completions by fuzzy_score()
+    The last word of the line is the pattern. The callback completes the line up to that word,
+    and the completions are ranked by how well the rest of each one matches the pattern.
+    Large completion sets are scored in chunks on a process pool. Its workers are started by a
+    forkserver, which imports the main module, so the program needs an if __name__ == "__main__" guard.
+    """
+
+    def __init__(self, fn, limit=0, parallel=_FUZZY_PARALLEL, workers=None, vectorize=False):
+        if vectorize:
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                # numpy is optional, score in Python
+                vectorize = False
+        self.fn = fn  # the wrapped completion callback
+        self.limit = limit  # maximum number of completions returned, 0 for all
+        self.parallel = parallel  # score this many completions or more on the process pool, 0 never does
+        self.workers = workers or os.cpu_count() or 1  # processes in the pool
+        self.vectorize = vectorize  # score with numpy
+        self.pool = None  # process pool, started when it's first needed
+        self.lock = threading.Lock()  # completions may run on worker threads
+
+    def __call__(self, line):
+        """return the completions of the line, best match first"""
+        cut = line.rfind(" ") + 1
+        head, pattern = line[:cut], line[cut:]
+        if pattern == "":
+            return self.fn(line)
+        lc = self.fn(head)
+        if lc is None:
+            return None
+        if head:
+            lc = [c for c in lc if c.startswith(head)]
+            candidates = [c[cut:] for c in lc]
+        else:
+            lc = candidates = list(lc)
+        matches = self.scores(pattern, candidates)
+
+        def key(m):
+            # best score, then the shortest completion, then the callback order
+            return (-m[1], len(candidates[m[0]]), m[0])
+
+        if self.limit:
+            matches = heapq.nsmallest(self.limit, matches, key=key)
+        else:
+            matches.sort(key=key)
+        return [lc[i] for i, _ in matches]
+
+    def scores(self, pattern, candidates):
+        """return the (index, score) of the candidates matching the pattern"""
+        n = len(candidates)
+        if self.parallel == 0 or n < self.parallel or self.workers < 2:
+            return fuzzy_scores(pattern, candidates, self.vectorize)
+        with self.lock:
+            if self.pool is None:
+                # forking a process with other threads (completion, history writer) can deadlock the child
+                ctx = multiprocessing.get_context("forkserver")
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=ctx)
+            pool = self.pool
+        size = -(-n // self.workers)
+        chunks = [candidates[k : k + size] for k in range(0, n, size)]
+        results = pool.map(fuzzy_scores, itertools.repeat(pattern), chunks, itertools.repeat(self.vectorize))
+        matches = []
+        for k, m in enumerate(results):
+            matches.extend((k * size + i, score) for i, score in m)
+        return matches
+
+    def close(self):
+        """stop the process pool"""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
 class line_state:
     """line editing state"""
 
@@ -186,70 +1020,139 @@ class line_state:
         self.ofd = ofd  # stdout file descriptor
         self.prompt = prompt  # prompt string
         self.ts = ts  # terminal state
+        self.input = ts.get_input(ifd)  # buffered input stream
         self.history_idx = 0  # history index we are currently editing, 0 is the LAST entry
-        self.buf = []  # line buffer
-        self.cols = get_columns(ifd, ofd)  # number of columns in terminal
+        self.prefix = None  # (prefix, line shown) of the history prefix search
+        self.matches = []  # sequence numbers of the history lines matching the prefix, latest first
+        self.pending = iter(())  # the matches not yet found
+        self.match = -1  # index of the match shown, -1 for the original line
+        self.original = ""  # the line before the history prefix search
+        self.completion = None  # background completion task
+        self.buf = line_buffer()  # line buffer
+        self.cols = get_columns(self.input, ofd)  # number of columns in terminal
         self.pos = 0  # current cursor position within line buffer
         self.oldpos = 0  # previous refresh cursor position (multiline)
         self.maxrows = 0  # maximum num of rows used so far (multiline)
-
-    def refresh_show_hints(self):
-        """show hints to the right of the cursor"""
-        if self.ts.hints_callback is None:
+        self.screen = None  # what is on the screen, None forces a full refresh (differential)
+        self.screen_col = 0  # cursor column on the screen (differential)
+        self.defer = False  # defer refreshes until the edit loop has handled the pending input
+        self.dirty = False  # is there a deferred refresh?
+        self.refresh_time = 0.0  # time of the last refresh
+        self.done = False  # has editing finished?
+        self.result = None  # the result of editing
+
+    def refresh_hint(self):
+        """return the hint to the right of the cursor and its style sequence"""
+        if self.ts.hints_callback is None and self.completion is None:
             # no hints
-            return []
+            return ("", "")
         if len(self.prompt) + len(self.buf) >= self.cols:
             # no space to display hints
-            return []
+            return ("", "")
+        if self.completion_pending():
+            hlen = self.cols - len(self.prompt) - len(self.buf)
+            return (_COMPLETION_PENDING[:hlen], "\033[0;90;49m")
+        if self.ts.hints_callback is None:
+            return ("", "")
         # get the hint
         result = self.ts.hints_callback(str(self))
         if result is None:
             # no hints
-            return []
+            return ("", "")
         (hint, color, bold) = result
         if hint is None or len(hint) == 0:
             # no hints
-            return []
+            return ("", "")
         # work out the hint length
         hlen = min(len(hint), self.cols - len(self.prompt) - len(self.buf))
-        seq = []
         if bold and color < 0:
             color = 37
+        style = ""
         if color >= 0 or bold:
-            seq.append("\033[%d;%d;49m" % ((0, 1)[bold], color))
-        seq.append(hint[:hlen])
-        if color >= 0 or bold:
-            seq.append("\033[0m")
-        return seq
+            style = "\033[%d;%d;49m" % ((0, 1)[bold], color)
+        return (hint[:hlen], style)
+
+    def refresh_show_hints(self):
+        """show hints to the right of the cursor"""
+        return _styled(*self.refresh_hint())
+
+    def refresh_window(self):
+        """return the start and length of the visible line buffer, and the visible cursor position"""
+        plen = len(self.prompt)
+        # scroll the characters to the left if we are at max columns
+        idx = max(0, plen + self.pos - self.cols + 1)
+        blen = min(len(self.buf) - idx, self.cols - plen)
+        return (idx, blen, self.pos - idx)
 
     def refresh_singleline(self):
         """single line refresh"""
+        if self.ts.diffmode and self.screen is not None:
+            self.refresh_diff()
+            return
         seq = []
         plen = len(self.prompt)
-        blen = len(self.buf)
-        idx = 0
-        pos = self.pos
-        # scroll the characters to the left if we are at max columns
-        while (plen + pos) >= self.cols:
-            idx += 1
-            blen -= 1
-            pos -= 1
-        while (plen + blen) > self.cols:
-            blen -= 1
+        (idx, blen, pos) = self.refresh_window()
+        visible = self.buf[idx : idx + blen]
         # cursor to the left edge
         seq.append("\r")
         # write the prompt
         seq.append(self.prompt)
         # write the current buffer content
-        seq.append("".join([self.buf[i] for i in range(idx, idx + blen)]))
+        seq.append(visible)
         # Show hints (if any)
-        seq.extend(self.refresh_show_hints())
+        (hint, style) = self.refresh_hint()
+        seq.extend(_styled(hint, style))
         # Erase to right
         seq.append("\x1b[0K")
         # Move cursor to original position
         seq.append("\r\x1b[%dC" % (plen + pos))
         # write it out
         _puts(self.ofd, "".join(seq))
+        if self.ts.diffmode:
+            # remember what is on the screen
+            self.screen = (self.prompt + visible + hint, plen + blen, style)
+            self.screen_col = plen + pos
+
+    def refresh_diff(self):
+        """
+        single line refresh: only output the changes to what is on the screen
+        self.screen is (text, hint start, hint style) for what is on the screen.
+        """
+        plen = len(self.prompt)
+        (idx, blen, pos) = self.refresh_window()
+        (hint, style) = self.refresh_hint()
+        text = "".join((self.prompt, self.buf[idx : idx + blen], hint))
+        hstart = plen + blen
+        (otext, ohstart, ostyle) = self.screen
+        # find the first column that differs
+        n = min(len(text), len(otext))
+        d = 0
+        while d < n and text[d] == otext[d]:
+            d += 1
+        if (hstart, style) != (ohstart, ostyle) and style + ostyle:
+            # the styled hint has moved, rewrite it
+            d = min(d, hstart, ohstart)
+        seq = []
+        col = self.screen_col
+        if d < len(text) or d < len(otext):
+            seq.append(_cursor_move(col, d))
+            col = d
+            if d < len(text):
+                # write the changed text, the hint is styled
+                if d < hstart:
+                    seq.append(text[d:hstart])
+                seq.extend(_styled(text[max(d, hstart) :], style))
+                # at the right margin the cursor position is terminal dependent
+                col = (len(text), -1)[len(text) >= self.cols]
+            if len(otext) > len(text):
+                # Erase to right
+                seq.append("\x1b[0K")
+        # Move cursor to original position
+        seq.append(_cursor_move(col, plen + pos))
+        # write it out
+        _puts(self.ofd, "".join(seq))
+        self.screen = (text, hstart, style)
+        self.screen_col = plen + pos
 
     def refresh_multiline(self):
         """multiline refresh"""
@@ -309,21 +1212,35 @@ class line_state:
 
     def refresh_line(self):
         """refresh the edit line"""
+        if self.defer:
+            # coalesce refreshes, the edit loop will flush them
+            self.dirty = True
+            return
+        self.dirty = False
+        self.refresh_time = time.monotonic()
         if self.ts.mlmode:
             self.refresh_multiline()
         else:
             self.refresh_singleline()
 
+    def flush(self):
+        """carry out any deferred refresh"""
+        if self.dirty:
+            defer = self.defer
+            self.defer = False
+            self.refresh_line()
+            self.defer = defer
+
     def edit_delete(self):
         """delete the character at the current cursor position"""
         if len(self.buf) > 0 and self.pos < len(self.buf):
-            self.buf.pop(self.pos)
+            self.buf.delete(self.pos, self.pos + 1)
             self.refresh_line()
 
     def edit_backspace(self):
         """delete the character to the left of the current cursor position"""
         if self.pos > 0 and len(self.buf) > 0:
-            self.buf.pop(self.pos - 1)
+            self.buf.delete(self.pos - 1, self.pos)
             self.pos -= 1
             self.refresh_line()
 
@@ -333,12 +1250,18 @@ class line_state:
         self.pos += 1
         self.refresh_line()
 
+    def edit_insert_string(self, s):
+        """insert a string at the current cursor position"""
+        if len(s) == 0:
+            return
+        self.buf.insert(self.pos, s)
+        self.pos += len(s)
+        self.refresh_line()
+
     def edit_swap(self):
         """swap current character with the previous character"""
         if self.pos > 0 and self.pos < len(self.buf):
-            tmp = self.buf[self.pos - 1]
-            self.buf[self.pos - 1] = self.buf[self.pos]
-            self.buf[self.pos] = tmp
+            self.buf.replace(self.pos - 1, self.pos + 1, self.buf[self.pos] + self.buf[self.pos - 1])
             if self.pos != len(self.buf) - 1:
                 self.pos += 1
             self.refresh_line()
@@ -347,7 +1270,7 @@ class line_state:
         """set the line buffer to a string"""
         if s is None:
             return
-        self.buf = list(s)
+        self.buf.set(s)
         self.pos = len(self.buf)
         self.refresh_line()
 
@@ -377,13 +1300,13 @@ class line_state:
 
     def delete_line(self):
         """delete the line"""
-        self.buf = []
+        self.buf.set("")
         self.pos = 0
         self.refresh_line()
 
     def delete_to_end(self):
         """delete from the current cursor postion to the end of the line"""
-        self.buf = self.buf[: self.pos]
+        self.buf.delete(self.pos, len(self.buf))
         self.refresh_line()
 
     def delete_prev_word(self):
@@ -395,15 +1318,124 @@ class line_state:
         # remove word
         while self.pos > 0 and self.buf[self.pos - 1] != " ":
             self.pos -= 1
-        self.buf = self.buf[: self.pos] + self.buf[old_pos:]
+        self.buf.delete(self.pos, old_pos)
+        self.refresh_line()
+
+    def line_completions(self):
+        """return a completion_stream for the line, taking the background completions if there are any"""
+        if self.completion is not None:
+            task = self.completion
+            self.completion = None
+            if task.error is not None:
+                raise task.error
+            lc = task.result
+        else:
+            lc = self.ts.completions(str(self))
+        return completion_stream(self.ts.completions, str(self), lc, self.ts.completion_buffer)
+
+    def complete(self):
+        """complete the line, return the key that ended the completion (or _KEY_NULL)"""
+        if self.ts.completion_listing is not None:
+            self.complete_list()
+            return _KEY_NULL
+        return self.complete_line()
+
+    def complete_list(self):
+        """
+        complete the line as bash does: extend it to the longest common prefix of its completions,
+        otherwise list them in columns below the line
+        """
+        self.flush()
+        defer = self.defer
+        self.defer = False
+        line = str(self)
+        lc = self.line_completions()
+        # one pass for the number of completions and their common prefix
+        n = 0
+        prefix = None
+        while True:
+            s = lc.get(n)
+            if s is None:
+                break
+            prefix = s if prefix is None else os.path.commonprefix((prefix, s))
+            n += 1
+            if n > 1 and len(prefix) <= len(line):
+                # the line can't be extended, just count the rest
+                n = lc.count()
+                break
+        if n == 0:
+            # no line completions
+            beep()
+        elif n == 1 or (len(prefix) > len(line) and prefix.startswith(line)):
+            self.buf.set(prefix)
+            self.pos = len(self.buf)
+            self.refresh_line()
+        else:
+            self.list_completions(lc, n)
+        self.defer = defer
+
+    def list_completions(self, lc, n):
+        """
+        list the completions below the line, then redraw the line
+        Ask before listing more than the threshold, and page a listing taller than the terminal.
+        """
+        line = str(self)
+        pos = self.pos
+        if self.ts.mlmode:
+            # go to the last row of the line
+            self.pos = len(self.buf)
+            self.refresh_line()
+        _puts(self.ofd, "\r\n")
+        show = True
+        if n > self.ts.completion_listing:
+            _puts(self.ofd, "Show all %d? (y/n)" % n)
+            c = self.ts.decoder.get_key(self.input)
+            show = c in ("y", "Y", " ")
+            _puts(self.ofd, "\r\n")
+        if show:
+            # leave out the words of the line the completions start with
+            cut = line.rfind(" ") + 1
+            items = []
+            for i in range(n):
+                s = lc.get(i)
+                if s is None:
+                    # the callback has changed its mind
+                    break
+                items.append(s[cut:] if s.startswith(line[:cut]) else s)
+            rows = column_rows(items, self.cols)
+            page = max(1, query_rows(self.ofd) - 1)
+            i = 0
+            while True:
+                _puts(self.ofd, "".join(r + "\r\n" for r in rows[i : i + page]))
+                i += page
+                if i >= len(rows):
+                    break
+                # space for the next page, enter for the next row
+                _puts(self.ofd, "--More--")
+                c = self.ts.decoder.get_key(self.input)
+                _puts(self.ofd, "\r\x1b[0K")
+                if c == " ":
+                    page = max(1, query_rows(self.ofd) - 1)
+                elif c == _KEY_ENTER:
+                    page = 1
+                else:
+                    break
+        # redraw the line below the listing
+        self.pos = pos
+        self.oldpos = 0
+        self.maxrows = 0
+        self.screen = None
         self.refresh_line()
 
     def complete_line(self):
         """show completions for the current line"""
         c = _KEY_NULL
-        # get a list of line completions
-        lc = self.ts.completion_callback(str(self))
-        if lc is None or len(lc) == 0:
+        # completions are shown as we go
+        self.flush()
+        defer = self.defer
+        self.defer = False
+        lc = self.line_completions()
+        if lc.get(0) is None:
             # no line completions
             beep()
         else:
@@ -411,12 +1443,13 @@ class line_state:
             stop = False
             idx = 0
             while not stop:
-                if idx < len(lc):
+                line = lc.get(idx)
+                if line is not None:
                     # save the line buffer
                     saved_buf = self.buf
                     saved_pos = self.pos
                     # show the completion
-                    self.buf = list(lc[idx])
+                    self.buf = line_buffer(line)
                     self.pos = len(self.buf)
                     self.refresh_line()
                     # restore the line buffer
@@ -426,43 +1459,1791 @@ class line_state:
                     # show the original buffer
                     self.refresh_line()
                 # navigate through the completions
-                c = _getc(self.ifd)
+                c = self.ts.decoder.get_key(self.input)
                 if c == _KEY_NULL:
                     # error on read
                     stop = True
                 elif c == _KEY_TAB:
-                    # loop through the completions
-                    idx = (idx + 1) % (len(lc) + 1)
-                    if idx == len(lc):
+                    # loop through the completions, then the original buffer
+                    idx = 0 if line is None else idx + 1
+                    if lc.get(idx) is None:
                         beep()
                 elif c == _KEY_ESC:
-                    # could be an escape, could be an escape sequence
-                    if would_block(self.ifd, _CHAR_TIMEOUT):
-                        # nothing more to read, looks like a single escape
-                        # re-show the original buffer
-                        if idx < len(lc):
-                            self.refresh_line()
-                        # don't pass the escape key back
-                        c = _KEY_NULL
-                    else:
-                        # probably an escape sequence
-                        # update the buffer and return
-                        if idx < len(lc):
-                            self.buf = list(lc[idx])
-                            self.pos = len(self.buf)
+                    # a single escape: re-show the original buffer
+                    if line is not None:
+                        self.refresh_line()
+                    # don't pass the escape key back
+                    c = _KEY_NULL
                     stop = True
                 else:
                     # update the buffer and return
-                    if idx < len(lc):
-                        self.buf = list(lc[idx])
+                    if line is not None:
+                        self.buf.set(line)
                         self.pos = len(self.buf)
                     stop = True
-        # return the last character read
+        self.defer = defer
+        # return the last key read
+        return c
+
+    def complete_async(self):
+        """
+        complete the line on a worker thread, wait for the completions until the deadline
+        Return True if they are ready. Otherwise the line shows they are pending and the edit
+        loop takes them when they are ready. Changing the line cancels them.
+        """
+        line = str(self)
+        task = self.completion
+        if task is None or task.line != line:
+            # supersede any completion for an older line
+            task = completion_task(self.ts.completions, line)
+            self.completion = task
+        end = time.monotonic() + self.ts.completion_deadline
+        while not task.done.wait(max(0.0, min(_COMPLETION_POLL, end - time.monotonic()))):
+            # stop waiting for a key
+            if time.monotonic() >= end or not self.input.would_block(0):
+                self.refresh_line()
+                return False
+        return True
+
+    def complete_ready(self):
+        """
+        return True if the background completions for the line are ready
+        A completion for a line that has since changed is dropped.
+        """
+        task = self.completion
+        if task is None:
+            return False
+        if task.line != str(self):
+            self.completion = None
+            return False
+        return task.done.is_set()
+
+    def completion_pending(self):
+        """return True if background completions for the line are pending"""
+        task = self.completion
+        return task is not None and not task.done.is_set() and task.line == str(self)
+
+    def completion_cancel(self):
+        """drop any background completion, remove the pending marker from the line"""
+        pending = self.completion_pending()
+        self.completion = None
+        if pending:
+            self.defer = False
+            self.refresh_line()
+
+    def history_prefix_step(self, older):
+        """
+        step to an older (or newer) history line starting with the text left of the cursor
+        With no text left of the cursor, step through all of the history.
+        """
+        ts = self.ts
+        prefix = self.buf[: self.pos]
+        line = str(self)
+        if self.prefix is None or self.prefix[1] != line or self.prefix[0] not in ("", prefix):
+            # the line has been edited: start again
+            self.prefix = None
+            if older and prefix:
+                self.pending = ts.history_prefix_matches(prefix, ts.history.seq(0))
+                self.matches = []
+                self.match = -1
+                self.original = line
+                self.prefix = (prefix, line)
+        if self.prefix is None or self.prefix[0] == "":
+            self.edit_set((ts.history_next, ts.history_prev)[older](self))
+            self.prefix = ("", str(self))
+            return
+        i = self.match + (-1, 1)[older]
+        if i == len(self.matches):
+            # find the next older match, skip copies of the original line
+            for s in self.pending:
+                if ts.history.by_seq(s) != self.original:
+                    self.matches.append(s)
+                    break
+        if i < -1 or i >= len(self.matches):
+            beep()
+        else:
+            self.match = i
+            line = self.original if i < 0 else ts.history.by_seq(self.matches[i])
+            self.buf.set(line)
+            self.pos = len(prefix)
+            self.refresh_line()
+        self.prefix = (prefix, line)
+
+    def search_history(self):
+        """
+        incremental reverse history search
+        Printable keys extend the search string, backspace undoes the last step, Ctrl-R finds
+        the next older match. Ctrl-G or escape cancels the search. Any other key takes the match
+        into the line buffer and is returned to be handled as usual.
+        """
+        self.flush()
+        defer = self.defer
+        self.defer = False
+        prompt = self.prompt
+        saved = str(self)
+        saved_pos = self.pos
+        ts = self.ts
+        # the latest history entry is our current buffer, so search before it
+        before = ts.history.seq(0)
+        query = ""
+        seq = None  # sequence number of the matched line
+        failed = False
+        undo = []
+        while True:
+            # show the match
+            line = saved if seq is None else ts.history.by_seq(seq)
+            self.prompt = "(%sreverse-i-search)`%s': " % (("", "failed ")[failed], query)
+            self.buf = line_buffer(line)
+            self.pos = saved_pos if seq is None else max(0, line.find(query))
+            self.refresh_line()
+            c = ts.decoder.get_key(self.input)
+            if c == _KEY_CTRL_R:
+                # next older match
+                s = ts.history_search(query, before if seq is None else seq) if query else None
+                if s is None:
+                    beep()
+                else:
+                    undo.append((query, seq, failed))
+                    seq = s
+            elif c == _KEY_BS or c == _KEY_CTRL_H:
+                # undo the last step
+                if undo:
+                    (query, seq, failed) = undo.pop()
+            elif len(c) == 1 and c >= " ":
+                # narrow the search, the current match may still match
+                undo.append((query, seq, failed))
+                query += c
+                s = ts.history_search(query, before if seq is None else seq + 1)
+                failed = s is None
+                if failed:
+                    beep()
+                else:
+                    seq = s
+            else:
+                break
+        self.prompt = prompt
+        self.buf = line_buffer(line)
+        if c == _KEY_CTRL_G or c == _KEY_ESC or c == _KEY_NULL:
+            # cancelled: back to the original buffer
+            self.buf.set(saved)
+            self.pos = saved_pos
+            c = _KEY_NULL
+        self.screen = None
+        self.refresh_line()
+        self.defer = defer
         return c
 
+    def finish(self, result):
+        """finish editing, edit() will return the result"""
+        self.done = True
+        self.result = result
+
     def __str__(self):
         """return a string for the line buffer"""
-        return "".join(self.buf)
+        return str(self.buf)
+
+
+# -----------------------------------------------------------------------------
+# key bindings
+
+
+class keymap:
+    """
+    map key events to editor actions
+    An action is called as fn(ls, key) with the line state and the key event.
+    Keymaps stack: keys that are not bound in a keymap are looked up in its parent.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent  # keymap for unbound keys
+        self.keys = {}  # key event to action
+
+    def bind(self, key, fn):
+        """bind a key event to an action"""
+        self.keys[key] = fn
+
+    def unbind(self, key):
+        """remove a key binding from this keymap"""
+        self.keys.pop(key, None)
+
+    def lookup(self, key):
+        """return the action for a key event, None if it is not bound"""
+        km = self
+        while km is not None:
+            fn = km.keys.get(key)
+            if fn is not None:
+                return fn
+            km = km.parent
+        return None
+
+
+def action_accept(ls, key):
+    """accept the line"""
+    ls.ts.history.pop()
+    # the final refresh can't be deferred
+    ls.defer = False
+    # drop any background completion, the refresh removes its pending marker
+    pending = ls.completion_pending()
+    ls.completion = None
+    if ls.ts.hints_callback or pending:
+        # Refresh the line without hints to leave the
+        # line as the user typed it after the newline.
+        hcb = ls.ts.hints_callback
+        ls.ts.hints_callback = None
+        ls.refresh_line()
+        ls.ts.hints_callback = hcb
+    ls.finish(str(ls))
+
+
+def action_hotkey(ls, key):
+    """accept the line with the key appended to it"""
+    action_accept(ls, key)
+    ls.finish(ls.result + key)
+
+
+def action_abandon(ls, key):
+    """abandon the line"""
+    ls.ts.history.pop()
+    ls.completion_cancel()
+    ls.finish("")
+
+
+def action_interrupt(ls, key):
+    """return None == EOF"""
+    ls.completion_cancel()
+    ls.finish(None)
+
+
+def action_eof_or_delete(ls, key):
+    """delete the character to the right of the cursor. If the line is empty act as an EOF."""
+    if len(ls.buf) != 0:
+        ls.edit_delete()
+    else:
+        ls.ts.history.pop()
+        ls.completion_cancel()
+        ls.finish(None)
+
+
+def action_insert(ls, key):
+    """insert the key into the line buffer"""
+    ls.edit_insert(key)
+
+
+def action_backspace(ls, key):
+    """remove the character to the left of the cursor"""
+    ls.edit_backspace()
+
+
+def action_delete(ls, key):
+    """remove the character at the cursor"""
+    ls.edit_delete()
+
+
+def action_move_left(ls, key):
+    """cursor left"""
+    ls.edit_move_left()
+
+
+def action_move_right(ls, key):
+    """cursor right"""
+    ls.edit_move_right()
+
+
+def action_move_home(ls, key):
+    """go to the start of the line"""
+    ls.edit_move_home()
+
+
+def action_move_end(ls, key):
+    """go to the end of the line"""
+    ls.edit_move_end()
+
+
+def action_history_prev(ls, key):
+    """previous history item"""
+    ls.edit_set(ls.ts.history_prev(ls))
+
+
+def action_history_next(ls, key):
+    """next history item"""
+    ls.edit_set(ls.ts.history_next(ls))
+
+
+def action_history_prefix_prev(ls, key):
+    """previous history item starting with the text left of the cursor"""
+    ls.history_prefix_step(True)
+
+
+def action_history_prefix_next(ls, key):
+    """next history item starting with the text left of the cursor"""
+    ls.history_prefix_step(False)
+
+
+def action_delete_to_end(ls, key):
+    """delete to the end of the line"""
+    ls.delete_to_end()
+
+
+def action_delete_line(ls, key):
+    """delete the whole line"""
+    ls.delete_line()
+
+
+def action_delete_prev_word(ls, key):
+    """delete the previous word"""
+    ls.delete_prev_word()
+
+
+def action_swap(ls, key):
+    """swap the current character with the previous"""
+    ls.edit_swap()
+
+
+def action_resize(ls, key):
+    """the terminal has been resized, redraw the line"""
+    ls.cols = get_columns(ls.input, ls.ofd)
+    ls.screen = None
+    ls.refresh_line()
+
+
+def action_search(ls, key):
+    """incremental reverse history search"""
+    c = ls.search_history()
+    if c != _KEY_NULL:
+        ls.ts.edit_key(ls, c)
+
+
+def action_clear_screen(ls, key):
+    """clear the screen"""
+    clear_screen()
+    ls.screen = None
+    ls.refresh_line()
+
+
+def action_complete(ls, key):
+    """autocomplete when the callback is set, otherwise insert the key"""
+    if ls.ts.completion_callback is None:
+        ls.edit_insert(key)
+        return
+    if ls.ts.completion_deadline is not None and not ls.complete_async():
+        # pending: the edit loop shows the completions when they are ready
+        return
+    # handle the key that ended the completion
+    c = ls.complete()
+    if c != _KEY_NULL:
+        ls.ts.edit_key(ls, c)
+
+
+def action_paste(ls, key):
+    """bracketed paste: insert the pasted text in one go"""
+    ls.edit_insert_string(paste_filter(ls.input.read_until(_PASTE_END, _PASTE_TIMEOUT)))
+
+
+# the default key bindings
+emacs_keymap = keymap()
+for key, fn in (
+    (_KEY_ENTER, action_accept),
+    (_KEY_ESC, action_abandon),
+    (_KEY_TAB, action_complete),
+    (_KEY_BS, action_backspace),
+    (_KEY_CTRL_H, action_backspace),
+    (_KEY_DELETE, action_delete),
+    (_KEY_UP, action_history_prev),
+    (_KEY_CTRL_P, action_history_prev),
+    (_KEY_DOWN, action_history_next),
+    (_KEY_CTRL_N, action_history_next),
+    (_KEY_LEFT, action_move_left),
+    (_KEY_CTRL_B, action_move_left),
+    (_KEY_RIGHT, action_move_right),
+    (_KEY_CTRL_F, action_move_right),
+    (_KEY_HOME, action_move_home),
+    (_KEY_CTRL_A, action_move_home),
+    (_KEY_END, action_move_end),
+    (_KEY_CTRL_E, action_move_end),
+    (_KEY_CTRL_C, action_interrupt),
+    (_KEY_CTRL_D, action_eof_or_delete),
+    (_KEY_CTRL_K, action_delete_to_end),
+    (_KEY_CTRL_L, action_clear_screen),
+    (_KEY_CTRL_T, action_swap),
+    (_KEY_CTRL_U, action_delete_line),
+    (_KEY_CTRL_W, action_delete_prev_word),
+    (_KEY_CTRL_R, action_search),
+    (_KEY_PASTE, action_paste),
+    (_KEY_RESIZE, action_resize),
+):
+    emacs_keymap.bind(key, fn)
+
+# -----------------------------------------------------------------------------
+# bracketed paste
+
+_PASTE_ON = "\x1b[?2004h"  # enable bracketed paste mode
+_PASTE_OFF = "\x1b[?2004l"  # disable bracketed paste mode
+_PASTE_END = "\x1b[201~"  # end of pasted text marker
+
+# pasted line breaks and tabs become spaces (the line is drawn one column per character),
+# other control characters are dropped
+_PASTE_TABLE = {c: None for c in range(32)}
+_PASTE_TABLE.update({ord("\r"): " ", ord("\n"): " ", ord(_KEY_TAB): " "})
+
+
+def paste_filter(s):
+    """return the pasted string as it should be inserted into the line buffer"""
+    return s.replace("\r\n", "\n").translate(_PASTE_TABLE)
+
+
+# -----------------------------------------------------------------------------
+# history storage
+
+
+class history_ring:
+    """
+    ring buffer of history strings
+    Adding a line evicts the oldest line when the ring is full. Appending, evicting
+    and indexing (from either end) are O(1).
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen  # maximum number of lines
+        self.items = []  # ring storage, grows up to maxlen
+        self.head = 0  # index of the oldest line
+        self.count = 0  # number of lines
+        self.first = 0  # sequence number of the oldest line
+
+    def slot(self, i):
+        """return the ring index for a line index (0 is the oldest)"""
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("history index out of range")
+        return (self.head + i) % len(self.items)
+
+    def append(self, line):
+        """add a line, return the evicted line (or None)"""
+        if self.maxlen == 0:
+            return None
+        if self.count < len(self.items):
+            # there's a free slot
+            self.items[(self.head + self.count) % len(self.items)] = line
+            self.count += 1
+            return None
+        if len(self.items) < self.maxlen:
+            # grow the storage
+            if self.head:
+                self.items = self.items[self.head :] + self.items[: self.head]
+                self.head = 0
+            self.items.append(line)
+            self.count += 1
+            return None
+        # full: replace the oldest line
+        evicted = self.items[self.head]
+        self.items[self.head] = line
+        self.head = (self.head + 1) % len(self.items)
+        self.first += 1
+        return evicted
+
+    def pop(self):
+        """remove and return the latest line"""
+        i = self.slot(-1)
+        line = self.items[i]
+        self.items[i] = None
+        self.count -= 1
+        return line
+
+    def get(self, idx):
+        """get a line by reverse index (0 is the latest)"""
+        return self.items[self.slot(self.count - 1 - idx)]
+
+    def set(self, idx, line):
+        """set a line by reverse index (0 is the latest)"""
+        self.items[self.slot(self.count - 1 - idx)] = line
+
+    def seq(self, idx):
+        """return the sequence number of a line by reverse index (0 is the latest)"""
+        return self.first + self.count - 1 - idx
+
+    def by_seq(self, seq):
+        """return the line with a sequence number, None if it isn't in the history"""
+        i = seq - self.first
+        if i < 0 or i >= self.count:
+            return None
+        return self.items[(self.head + i) % len(self.items)]
+
+    def set_maxlen(self, n):
+        """set the maximum number of lines, retain the latest lines"""
+        lines = list(self)[max(0, self.count - n) :]
+        self.first += self.count - len(lines)
+        self.maxlen = n
+        self.items = lines
+        self.head = 0
+        self.count = len(lines)
+
+    def clear(self):
+        """remove all lines"""
+        self.first += self.count
+        self.items = []
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """get a line by index (0 is the oldest)"""
+        return self.items[self.slot(i)]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.items[(self.head + i) % len(self.items)]
+
+    def entries(self):
+        """yield (sequence number, line) for the lines, oldest first"""
+        return enumerate(self, self.first)
+
+    def before(self, seq):
+        """yield (sequence number, line) for the lines before a sequence number, latest first"""
+        for s in range(min(seq, self.first + len(self)) - 1, self.first - 1, -1):
+            yield (s, self.by_seq(s))
+
+
+class history_packed:
+    """
+    history lines packed into one UTF-8 buffer
+    A list of strings costs 50+ bytes per line on top of the text, this costs a 4 byte offset.
+    Lines are decoded when they are used. Evicted lines leave dead space at the front of the
+    buffer, which is dropped once there are more dead lines than live ones. Changes to lines
+    other than the latest are kept aside, so the buffer is only ever changed at its ends.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen  # maximum number of lines
+        self.data = bytearray()  # the encoded lines
+        self.offsets = array.array("I", (0,))  # start offsets of the lines, then the end of the last line
+        self.lo = 0  # index of the oldest line in the offsets
+        self.changed = {}  # sequence number to changed line
+        self.first = 0  # sequence number of the oldest line
+
+    def index(self, i):
+        """return the offsets index for a line index (0 is the oldest)"""
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("history index out of range")
+        return self.lo + i
+
+    def packed(self, j):
+        """return the packed line at an offsets index"""
+        return self.data[self.offsets[j] : self.offsets[j + 1]].decode("utf8", "surrogatepass")
+
+    def line(self, j):
+        """return the line at an offsets index"""
+        if self.changed:
+            line = self.changed.get(self.first + j - self.lo)
+            if line is not None:
+                return line
+        return self.packed(j)
+
+    def compact(self):
+        """drop the dead space at the front of the buffer"""
+        base = self.offsets[self.lo]
+        del self.data[:base]
+        self.offsets = array.array("I", [o - base for o in self.offsets[self.lo :]])
+        self.lo = 0
+
+    def append(self, line):
+        """add a line, return the evicted line (or None)"""
+        if self.maxlen == 0:
+            return None
+        evicted = None
+        if len(self) >= self.maxlen:
+            # evict the oldest line
+            evicted = self.line(self.lo)
+            self.changed.pop(self.first, None)
+            self.lo += 1
+            self.first += 1
+            if self.lo > len(self):
+                self.compact()
+        self.data += line.encode("utf8", "surrogatepass")
+        self.offsets.append(len(self.data))
+        return evicted
+
+    def pop(self):
+        """remove and return the latest line"""
+        j = self.index(-1)
+        line = self.line(j)
+        self.changed.pop(self.first + j - self.lo, None)
+        del self.data[self.offsets[j] :]
+        self.offsets.pop()
+        return line
+
+    def get(self, idx):
+        """get a line by reverse index (0 is the latest)"""
+        return self.line(self.index(len(self) - 1 - idx))
+
+    def set(self, idx, line):
+        """set a line by reverse index (0 is the latest)"""
+        j = self.index(len(self) - 1 - idx)
+        seq = self.first + j - self.lo
+        if idx == 0:
+            # repack the latest line
+            self.changed.pop(seq, None)
+            del self.data[self.offsets[j] :]
+            self.data += line.encode("utf8", "surrogatepass")
+            self.offsets[j + 1] = len(self.data)
+        elif line == self.packed(j):
+            self.changed.pop(seq, None)
+        else:
+            self.changed[seq] = line
+
+    def seq(self, idx):
+        """return the sequence number of a line by reverse index (0 is the latest)"""
+        return self.first + len(self) - 1 - idx
+
+    def by_seq(self, seq):
+        """return the line with a sequence number, None if it isn't in the history"""
+        i = seq - self.first
+        if i < 0 or i >= len(self):
+            return None
+        return self.line(self.lo + i)
+
+    def set_maxlen(self, n):
+        """set the maximum number of lines, retain the latest lines"""
+        drop = max(0, len(self) - n)
+        self.first += drop
+        self.lo += drop
+        self.changed = {s: l for s, l in self.changed.items() if s >= self.first}
+        self.compact()
+        self.maxlen = n
+
+    def clear(self):
+        """remove all lines"""
+        self.first += len(self)
+        self.data = bytearray()
+        self.offsets = array.array("I", (0,))
+        self.lo = 0
+        self.changed = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1 - self.lo
+
+    def __getitem__(self, i):
+        """get a line by index (0 is the oldest)"""
+        return self.line(self.index(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.line(self.lo + i)
+
+    def entries(self):
+        """yield (sequence number, line) for the lines, oldest first"""
+        return enumerate(self, self.first)
+
+    def before(self, seq):
+        """yield (sequence number, line) for the lines before a sequence number, latest first"""
+        for s in range(min(seq, self.first + len(self)) - 1, self.first - 1, -1):
+            yield (s, self.by_seq(s))
+
+
+class history_mmap:
+    """
+    history lines in a memory mapped file
+    Loading indexes the offsets of just the retained lines, working back from the end of the file.
+    Lines are decoded when they are used. Lines added or changed after loading are kept in memory.
+    The file must not be truncated while it is mapped.
+    """
+
+    def __init__(self, fname, maxlen):
+        self.maxlen = maxlen  # maximum number of lines
+        self.first = 0  # sequence number of the oldest line
+        self.mm = None  # the mapped file
+        self.offsets = array.array("Q", (0,))  # start offsets of the file lines, then the end of the last line + 1
+        self.lo = 0  # index of the oldest retained file line
+        self.changed = {}  # file line index to changed line
+        self.tail = history_ring(maxlen)  # lines added since loading
+        f = open(fname, "rb")
+        size = os.fstat(f.fileno()).st_size
+        if size and maxlen:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        if self.mm is None:
+            return
+        # index the latest maxlen lines
+        end = size - (self.mm[size - 1] == ord("\n"))
+        starts = []
+        pos = end
+        while len(starts) < maxlen:
+            i = self.mm.rfind(b"\n", 0, pos)
+            starts.append(i + 1)
+            if i < 0:
+                break
+            pos = i
+        starts.reverse()
+        starts.append(end + 1)
+        self.offsets = array.array("Q", starts)
+
+    def nfile(self):
+        """return the number of retained file lines"""
+        return len(self.offsets) - 1 - self.lo
+
+    def line(self, j):
+        """return a file line"""
+        if j in self.changed:
+            return self.changed[j]
+        return self.mm[self.offsets[j] : self.offsets[j + 1] - 1].decode("utf8", "replace").strip()
+
+    def drop(self, n):
+        """drop the n oldest file lines"""
+        for j in range(self.lo, self.lo + n):
+            self.changed.pop(j, None)
+        self.lo += n
+
+    def append(self, line):
+        """add a line, return the evicted line (or None)"""
+        if self.maxlen == 0:
+            return None
+        if len(self) >= self.maxlen and self.nfile():
+            # evict the oldest file line
+            evicted = self.line(self.lo)
+            self.drop(1)
+            self.first += 1
+            self.tail.append(line)
+            return evicted
+        evicted = self.tail.append(line)
+        if evicted is not None:
+            self.first += 1
+        return evicted
+
+    def pop(self):
+        """remove and return the latest line"""
+        if len(self.tail):
+            return self.tail.pop()
+        if self.nfile() == 0:
+            raise IndexError("history index out of range")
+        j = len(self.offsets) - 2
+        line = self.line(j)
+        self.changed.pop(j, None)
+        self.offsets.pop()
+        return line
+
+    def get(self, idx):
+        """get a line by reverse index (0 is the latest)"""
+        return self[len(self) - 1 - idx]
+
+    def set(self, idx, line):
+        """set a line by reverse index (0 is the latest)"""
+        i = len(self) - 1 - idx
+        if i >= self.nfile():
+            self.tail.set(idx, line)
+        elif i >= 0:
+            self.changed[self.lo + i] = line
+        else:
+            raise IndexError("history index out of range")
+
+    def seq(self, idx):
+        """return the sequence number of a line by reverse index (0 is the latest)"""
+        return self.first + len(self) - 1 - idx
+
+    def by_seq(self, seq):
+        """return the line with a sequence number, None if it isn't in the history"""
+        i = seq - self.first
+        if i < 0 or i >= len(self):
+            return None
+        return self[i]
+
+    def set_maxlen(self, n):
+        """set the maximum number of lines, retain the latest lines"""
+        drop = max(0, len(self) - n)
+        self.first += drop
+        k = min(drop, self.nfile())
+        self.drop(k)
+        self.tail.set_maxlen(len(self.tail) - (drop - k))
+        self.tail.set_maxlen(n)
+        self.maxlen = n
+
+    def clear(self):
+        """remove all lines"""
+        self.first += len(self)
+        self.mm = None
+        self.offsets = array.array("Q", (0,))
+        self.lo = 0
+        self.changed = {}
+        self.tail.clear()
+
+    def __len__(self):
+        return len(self.offsets) - 1 - self.lo + len(self.tail)
+
+    def __getitem__(self, i):
+        """get a line by index (0 is the oldest)"""
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("history index out of range")
+        if i < self.nfile():
+            return self.line(self.lo + i)
+        return self.tail[i - self.nfile()]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def entries(self):
+        """yield (sequence number, line) for the lines, oldest first"""
+        return enumerate(self, self.first)
+
+    def before(self, seq):
+        """yield (sequence number, line) for the lines before a sequence number, latest first"""
+        for s in range(min(seq, self.first + len(self)) - 1, self.first - 1, -1):
+            yield (s, self.by_seq(s))
+
+
+class history_unique:
+    """
+    history without duplicate lines
+    Adding a line that is already in the history erases the older copy, a hash index finds it in O(1).
+    Erased lines leave a hole. A Fenwick tree counts the lines around the holes so indexing is
+    O(log n), and the storage is compacted when the holes outnumber the lines.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen  # maximum number of lines
+        self.slots = []  # lines, None for a hole
+        self.seqs = array.array("Q")  # sequence numbers of the slots
+        self.tree = [0]  # Fenwick tree of the slots in use (1 based)
+        self.where = {}  # line to slot
+        self.count = 0  # number of lines
+        self.next = 0  # sequence number of the next line
+        self.erased = None  # (slot, line) of the copy erased by the latest append
+
+    def prefix(self, i):
+        """return the number of lines in the first i slots"""
+        n = 0
+        while i > 0:
+            n += self.tree[i]
+            i -= i & -i
+        return n
+
+    def update(self, slot, d):
+        """add d to the line count of a slot"""
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += d
+            i += i & -i
+
+    def slot(self, i):
+        """return the slot for a line index (0 is the oldest)"""
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("history index out of range")
+        # find the slot with i lines before it
+        pos = 0
+        n = len(self.tree) - 1
+        step = 1 << n.bit_length()
+        while step:
+            if pos + step <= n and self.tree[pos + step] <= i:
+                pos += step
+                i -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    def erase(self, slot):
+        """erase the line in a slot, return the line"""
+        line = self.slots[slot]
+        self.slots[slot] = None
+        if self.where.get(line) == slot:
+            del self.where[line]
+        self.update(slot, -1)
+        self.count -= 1
+        return line
+
+    def compact(self):
+        """remove the holes"""
+        keep = [i for i, l in enumerate(self.slots) if l is not None]
+        self.slots = [self.slots[i] for i in keep]
+        self.seqs = array.array("Q", (self.seqs[i] for i in keep))
+        self.where = {l: i for i, l in enumerate(self.slots)}
+        self.tree = [0] * (len(self.slots) + 1)
+        for i in range(1, len(self.tree)):
+            self.tree[i] += 1
+            j = i + (i & -i)
+            if j < len(self.tree):
+                self.tree[j] += self.tree[i]
+        self.erased = None
+
+    def append(self, line):
+        """add a line, return the evicted line (or None)"""
+        self.erased = None
+        if self.maxlen == 0:
+            return None
+        if len(self.slots) - self.count > max(self.count, 64):
+            self.compact()
+        # erase the older copy
+        slot = self.where.get(line)
+        if slot is not None:
+            self.erased = (slot, self.erase(slot))
+        # add the line
+        i = len(self.slots) + 1
+        self.tree.append(1 + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+        self.where[line] = len(self.slots)
+        self.slots.append(line)
+        self.seqs.append(self.next)
+        self.next += 1
+        self.count += 1
+        if self.count > self.maxlen:
+            return self.evict()
+        return None
+
+    def evict(self):
+        """erase the oldest line, return it"""
+        return self.erase(self.slot(0))
+
+    def pop(self):
+        """remove and return the latest line, restore any copy erased by adding it"""
+        slot = self.slot(-1)
+        line = self.erase(slot)
+        if slot == len(self.slots) - 1:
+            # the last slot can go
+            self.slots.pop()
+            self.seqs.pop()
+            self.tree.pop()
+            self.next -= 1
+            if self.erased is not None:
+                (slot, old) = self.erased
+                if self.slots[slot] is None and old not in self.where:
+                    # restore the erased copy, the popped line may have been changed since
+                    self.slots[slot] = old
+                    self.where[old] = slot
+                    self.update(slot, 1)
+                    self.count += 1
+        self.erased = None
+        return line
+
+    def get(self, idx):
+        """get a line by reverse index (0 is the latest)"""
+        return self.slots[self.slot(self.count - 1 - idx)]
+
+    def set(self, idx, line):
+        """set a line by reverse index (0 is the latest)"""
+        slot = self.slot(self.count - 1 - idx)
+        old = self.slots[slot]
+        if self.where.get(old) == slot:
+            del self.where[old]
+        self.slots[slot] = line
+        # a copy of the line in another slot keeps the index entry
+        self.where.setdefault(line, slot)
+
+    @property
+    def first(self):
+        """sequence number of the oldest line"""
+        if self.count == 0:
+            return self.next
+        return self.seqs[self.slot(0)]
+
+    def seq(self, idx):
+        """return the sequence number of a line by reverse index (0 is the latest)"""
+        if idx == 0 and self.count == 0:
+            return self.next - 1
+        return self.seqs[self.slot(self.count - 1 - idx)]
+
+    def by_seq(self, seq):
+        """return the line with a sequence number, None if it isn't in the history"""
+        i = bisect.bisect_left(self.seqs, seq)
+        if i < len(self.seqs) and self.seqs[i] == seq:
+            return self.slots[i]
+        return None
+
+    def set_maxlen(self, n):
+        """set the maximum number of lines, retain the latest lines"""
+        self.maxlen = n
+        while self.count > n:
+            self.evict()
+        self.erased = None
+
+    def clear(self):
+        """remove all lines"""
+        self.slots = []
+        self.seqs = array.array("Q")
+        self.tree = [0]
+        self.where = {}
+        self.count = 0
+        self.erased = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """get a line by index (0 is the oldest)"""
+        return self.slots[self.slot(i)]
+
+    def __iter__(self):
+        for line in self.slots:
+            if line is not None:
+                yield line
+
+    def entries(self):
+        """yield (sequence number, line) for the lines, oldest first"""
+        for i, line in enumerate(self.slots):
+            if line is not None:
+                yield (self.seqs[i], line)
+
+    def before(self, seq):
+        """yield (sequence number, line) for the lines before a sequence number, latest first"""
+        for i in range(bisect.bisect_left(self.seqs, seq) - 1, -1, -1):
+            if self.slots[i] is not None:
+                yield (self.seqs[i], self.slots[i])
+
+
+# the frecency of a history line halves over this time
+_HALF_LIFE = 7 * 24 * 60 * 60.0  # 1 week
+
+
+class history_frecent(history_unique):
+    """
+    history without duplicates, evicting the least frecent line when it's full
+    Frecency is the number of uses of a line, each decaying with age. Decay doesn't change the
+    order of the lines, so each line gets a fixed key when it's used and a min-heap of the keys
+    finds the line to evict in O(log n). The history can also be bounded by its size in bytes.
+    """
+
+    def __init__(self, maxlen, maxbytes=0, half_life=_HALF_LIFE):
+        history_unique.__init__(self, maxlen)
+        self.maxbytes = maxbytes  # maximum size of the lines in bytes, 0 for no limit
+        self.decay = math.log(2) / half_life  # decay rate of the frecency
+        self.stats = {}  # line to [key, uses, time of the last use]
+        self.heap = []  # (key, sequence number), stale entries are skipped
+        self.bytes = 0  # size of the lines in bytes
+        self.undo = None  # (line, stats) from before the latest append
+
+    def score(self, line, now):
+        """return the frecency of a line"""
+        st = self.stats.get(line)
+        if st is None:
+            return 0.0
+        return math.exp(st[0] - self.decay * now)
+
+    def append(self, line):
+        """add a line, return the evicted line (or None)"""
+        if self.maxlen == 0:
+            return None
+        old = self.stats.get(line)
+        now = time.time()
+        evicted = history_unique.append(self, line)
+        self.bytes += len(line.encode("utf8"))
+        self.use(line, (old[1] if old is not None else 0) + 1, now)
+        self.undo = (line, old)
+        while self.maxbytes and self.bytes > self.maxbytes and self.count > 1:
+            e = self.evict()
+            if evicted is None:
+                evicted = e
+        return evicted
+
+    def use(self, line, uses, now):
+        """set the stats of the latest line"""
+        # key = log(frecency) + decay * time, the same order at any later time
+        key = math.log(self.score(line, now) + 1.0) + self.decay * now
+        self.stats[line] = [key, uses, now]
+        heapq.heappush(self.heap, (key, self.seq(0)))
+        if len(self.heap) > 2 * self.count + 64:
+            # drop the stale entries
+            self.heap = [(self.stats[l][0], seq) for seq, l in self.entries()]
+            heapq.heapify(self.heap)
+
+    def touch(self):
+        """count another use of the latest line, it's used again rather than added again"""
+        line = self.get(0)
+        self.use(line, self.stats[line][1] + 1, time.time())
+
+    def evict(self):
+        """erase the least frecent line other than the latest, return it"""
+        latest = None
+        while True:
+            (key, seq) = heapq.heappop(self.heap)
+            line = self.by_seq(seq)
+            if line is None or self.stats.get(line, (None,))[0] != key:
+                # stale
+                continue
+            if seq == self.next - 1 and self.count > 1:
+                latest = (key, seq)
+                continue
+            break
+        if latest is not None:
+            heapq.heappush(self.heap, latest)
+        self.erase(bisect.bisect_left(self.seqs, seq))
+        if line not in self.where:
+            del self.stats[line]
+        return line
+
+    def erase(self, slot):
+        """erase the line in a slot, return the line"""
+        line = history_unique.erase(self, slot)
+        self.bytes -= len(line.encode("utf8"))
+        return line
+
+    def pop(self):
+        """remove and return the latest line, restore the state from before adding it"""
+        undo = self.undo
+        erased = self.erased
+        count = self.count
+        line = history_unique.pop(self)
+        if self.count == count:
+            # the erased copy was restored
+            self.bytes += len(erased[1].encode("utf8"))
+        if line not in self.where:
+            del self.stats[line]
+        if undo is not None and undo[1] is not None and undo[0] in self.where:
+            # the restored copy gets its stats back
+            self.stats[undo[0]] = undo[1]
+            heapq.heappush(self.heap, (undo[1][0], self.seqs[self.where[undo[0]]]))
+        self.undo = None
+        return line
+
+    def set(self, idx, line):
+        """set a line by reverse index (0 is the latest)"""
+        old = self.get(idx)
+        history_unique.set(self, idx, line)
+        self.bytes += len(line.encode("utf8")) - len(old.encode("utf8"))
+        if line not in self.stats:
+            # the changed line takes over the stats
+            self.stats[line] = list(self.stats[old])
+            heapq.heappush(self.heap, (self.stats[line][0], self.seq(idx)))
+        if old not in self.where:
+            del self.stats[old]
+
+    def set_maxlen(self, n):
+        """set the maximum number of lines, retain the most frecent lines"""
+        history_unique.set_maxlen(self, n)
+        self.undo = None
+
+    def clear(self):
+        """remove all lines"""
+        history_unique.clear(self)
+        self.stats = {}
+        self.heap = []
+        self.bytes = 0
+        self.undo = None
+
+
+class history_index:
+    """
+    trigram index of the history for substring searches
+    Each trigram maps to an ordered array of the sequence numbers of the lines containing it.
+    Lines that are evicted or changed leave stale entries behind. Candidates are checked
+    against the history so these do no harm, and the index is rebuilt when they pile up.
+    """
+
+    def __init__(self):
+        self.grams = {}  # trigram to array of sequence numbers
+        self.adds = 0  # number of lines added since the index was built
+
+    def add(self, seq, line):
+        """add a line to the index"""
+        for g in {line[i : i + 3] for i in range(len(line) - 2)}:
+            p = self.grams.get(g)
+            if p is None:
+                self.grams[g] = array.array("I", (seq,))
+            elif p[-1] <= seq:
+                p.append(seq)
+            else:
+                # a changed line
+                p.insert(bisect.bisect_right(p, seq), seq)
+        self.adds += 1
+
+    def build(self, store):
+        """build the index for the lines in a history store"""
+        grams = {}
+        for seq, line in store.entries():
+            for g in {line[i : i + 3] for i in range(len(line) - 2)}:
+                grams.setdefault(g, []).append(seq)
+        self.grams = {g: array.array("I", p) for g, p in grams.items()}
+        self.adds = 0
+
+    def stale(self, store):
+        """return True if the index should be rebuilt"""
+        return self.adds > 2 * len(store) + 1024
+
+    def search(self, store, query, before):
+        """
+        return the sequence number of the latest line before 'before' that contains query
+        return None if there is no such line, or -1 if the query is too short to use the index
+        """
+        if len(query) < 3:
+            return -1
+        # rarest trigrams first, they have the fewest candidates
+        lists = sorted((self.grams.get(g, ()) for g in {query[i : i + 3] for i in range(len(query) - 2)}), key=len)
+        # leapfrog down the lists to the next line that has all the trigrams
+        seq = before - 1
+        while seq >= store.first:
+            for p in lists:
+                i = bisect.bisect_right(p, seq) - 1
+                if i < 0:
+                    return None
+                if p[i] != seq:
+                    seq = p[i]
+                    break
+            else:
+                line = store.by_seq(seq)
+                if line is not None and query in line:
+                    return seq
+                seq -= 1
+        return None
+
+
+def _max_tree(keys):
+    """
+    return a max tree of the sequence numbers in keys, (line, sequence number) pairs
+    The leaves are nodes n..2n-1 for keys[0..n-1], node i is the maximum of nodes 2i and 2i+1.
+    """
+    n = len(keys)
+    tree = [-1] * n
+    tree.extend(map(operator.itemgetter(1), keys))
+    i = n
+    while i > 1:
+        # nodes j..i-1 from their children 2j..2i-1
+        j = (i + 1) // 2
+        tree[j:i] = map(max, tree[2 * j : 2 * i : 2], tree[2 * j + 1 : 2 * i : 2])
+        i = j
+    return tree
+
+
+class history_prefix:
+    """
+    sorted index of the history for prefix searches
+    The (line, sequence number) pairs are kept in sorted runs, the lines starting with a prefix are a
+    contiguous range of each run found by bisection. Each run has a max tree of its sequence numbers,
+    so the matches are found latest first without sorting them. Added lines start a new run and
+    runs are merged with shorter runs as they are added, so there are O(log n) runs.
+    Lines that are evicted or changed leave stale entries behind, these are checked against the
+    history and the index is rebuilt when they pile up.
+    """
+
+    def __init__(self):
+        self.runs = []  # (sorted (line, sequence number), max tree), longest first
+        self.adds = 0  # number of lines added since the index was built
+
+    def add(self, seq, line):
+        """add a line to the index"""
+        keys = [(line, seq)]
+        while self.runs and len(self.runs[-1][0]) <= len(keys):
+            # merge the runs (a new list, the matches of an earlier search may still be using the old one)
+            keys = sorted(self.runs.pop()[0] + keys)
+        self.runs.append((keys, _max_tree(keys)))
+        self.adds += 1
+
+    def build(self, store):
+        """build the index for the lines in a history store"""
+        keys = sorted((line, seq) for seq, line in store.entries())
+        self.runs = [(keys, _max_tree(keys))] if keys else []
+        self.adds = 0
+
+    def stale(self, store):
+        """return True if the index should be rebuilt"""
+        return self.adds > 2 * len(store) + 1024
+
+    def matches(self, prefix):
+        """yield (line, sequence number) for the lines that start with prefix, latest first"""
+        # the tree nodes covering the prefix range of each run
+        heap = []
+        runs = self.runs
+        for r, (keys, tree) in enumerate(runs):
+            n = len(keys)
+            lo = bisect.bisect_left(keys, (prefix,))
+            hi = bisect.bisect_left(keys, (prefix + _MAX_CHAR,), lo)
+            lo += n
+            hi += n
+            while lo < hi:
+                if lo & 1:
+                    heap.append((-tree[lo], r, lo))
+                    lo += 1
+                if hi & 1:
+                    hi -= 1
+                    heap.append((-tree[hi], r, hi))
+                lo >>= 1
+                hi >>= 1
+        heapq.heapify(heap)
+        # take the node with the latest sequence number, a leaf is a match
+        while heap:
+            (_, r, i) = heapq.heappop(heap)
+            (keys, tree) = runs[r]
+            if i >= len(keys):
+                yield keys[i - len(keys)]
+            else:
+                heapq.heappush(heap, (-tree[2 * i], r, 2 * i))
+                heapq.heappush(heap, (-tree[2 * i + 1], r, 2 * i + 1))
+
+
+class history_view:
+    """read only view of the history, oldest entry first"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, i):
+        return self.store[i]
+
+    def __iter__(self):
+        return iter(self.store)
+
+
+def _history_write(fname, lines, lock=False):
+    """
+    write the history lines to a file, return the number of lines
+    A temporary file is renamed over the file, so a crash never leaves it truncated,
+    and a memory mapped copy of the old file stays valid.
+    lock: return (number of lines, fd) for the new file, opened for appending and locked.
+    It's locked before it replaces the file, so no other session can append to it first.
+    """
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        f = os.fdopen(fd, "w", encoding="utf8", closefd=not lock)
+        n = 0
+        for l in lines:
+            f.write("%s\n" % l)
+            n += 1
+        f.flush()
+        os.fsync(fd)
+        f.close()
+        if lock:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_APPEND)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.replace(tmp, fname)
+    except BaseException:
+        if lock:
+            os.close(fd)
+        os.unlink(tmp)
+        raise
+    if lock:
+        return (n, fd)
+    return n
+
+
+class history_file:
+    """
+    append-only history file
+    Each new history line is appended to the file, so the cost of saving a line doesn't depend on
+    the size of the history. The file is rewritten with just the retained history when it grows
+    past a limit. A temporary file is renamed over it, so a crash never leaves it truncated.
+    Sessions sharing the file take an advisory lock to write it, and read just the lines that
+    were appended since their last read.
+    """
+
+    def __init__(self, fname, sync=0, limit=0, shared=False):
+        self.fname = fname
+        self.sync = sync  # fsync after this many lines, 0 leaves it to the OS
+        self.limit = limit  # compact the file when it has more lines than this
+        self.shared = shared  # pick up the lines appended by other sessions
+        self.unsynced = 0  # lines written since the last fsync
+        self.lines = 0  # lines in the file
+        self.offset = 0  # file offset of the lines we have read
+        self.fd = None
+        atexit.register(self.close)
+
+    def reopen(self):
+        """(re)open the file"""
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+        self.fd = os.open(self.fname, os.O_RDWR | os.O_APPEND | os.O_CREAT, stat.S_IRUSR | stat.S_IWUSR)
+        self.lines = 0
+        self.offset = 0
+
+    def open(self):
+        """open the file, return the lines in it"""
+        self.reopen()
+        self.lock()
+        try:
+            lines = self.read()
+            if self.offset < os.fstat(self.fd).st_size:
+                # terminate a partly written line
+                self.write("\n")
+                lines.extend(self.read())
+        finally:
+            self.unlock()
+        return lines
+
+    def lock(self):
+        """lock the file, return True if another session has replaced it since our last lock"""
+        replaced = False
+        while True:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                ino = os.stat(self.fname).st_ino
+            except FileNotFoundError:
+                ino = None
+            if ino == os.fstat(self.fd).st_ino:
+                return replaced
+            # compacted (or removed) by another session
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.reopen()
+            replaced = True
+
+    def unlock(self):
+        """unlock the file"""
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def read(self):
+        """return the lines appended since the last read (lock the file first)"""
+        n = os.fstat(self.fd).st_size - self.offset
+        if n <= 0:
+            return []
+        data = os.pread(self.fd, n, self.offset)
+        # complete lines only
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        lines = data.decode("utf8", "replace").splitlines()
+        self.lines += len(lines)
+        return lines
+
+    def append(self, line):
+        """append a line to the file (lock the file and read it first)"""
+        self.offset += self.write("%s\n" % line)
+        self.lines += 1
+        self.unsynced += 1
+        if self.sync and self.unsynced >= self.sync:
+            self.flush()
+
+    def write(self, s):
+        """write a string to the file, return the number of bytes written"""
+        data = s.encode("utf8")
+        n = len(data)
+        while len(data):
+            data = data[os.write(self.fd, data) :]
+        return n
+
+    def flush(self):
+        """fsync any lines written since the last fsync"""
+        if self.unsynced and self.fd is not None:
+            os.fsync(self.fd)
+            self.unsynced = 0
+
+    def full(self, maxlen):
+        """
+        return True if the file should be compacted, maxlen is the history length
+        Compacting leaves up to maxlen lines, so the limit is at least 1.5 * maxlen to keep
+        the rewrites to one per maxlen / 2 lines appended.
+        """
+        return self.lines > max(self.limit or 2 * maxlen, maxlen + maxlen // 2)
+
+    def compact(self, lines):
+        """replace the file contents with lines (lock the file first)"""
+        (n, fd) = _history_write(self.fname, lines, lock=True)
+        # closing the old file unlocks it, we hold the lock on the new file
+        self.flush()
+        os.close(self.fd)
+        self.fd = fd
+        self.offset = os.fstat(fd).st_size
+        self.lines = n
+        self.unsynced = 0
+
+    def close(self):
+        """flush and close the file"""
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+        atexit.unregister(self.close)
+
+
+_HISTORY_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY,
+        line TEXT NOT NULL,
+        time REAL NOT NULL,
+        session TEXT NOT NULL,
+        cwd TEXT,
+        status INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS history_session ON history (session, id)",
+)
+
+_HISTORY_FTS = (
+    """CREATE VIRTUAL TABLE history_fts USING fts5 (
+        line, content='history', content_rowid='id', tokenize='trigram case_sensitive 1'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+        INSERT INTO history_fts (rowid, line) VALUES (new.id, new.line);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN
+        INSERT INTO history_fts (history_fts, rowid, line) VALUES ('delete', old.id, old.line);
+    END""",
+)
+
+
+class history_db:
+    """
+    history database (sqlite3)
+    Each history line is stored with its time, session, working directory and exit status.
+    The database is in WAL mode: sessions read it while another one writes, and writers wait
+    their turn. A full-text (trigram) index keeps substring searches fast, and only the latest
+    lines are loaded into memory. The locking follows history_file, so the two are interchangeable.
+    """
+
+    def __init__(self, fname, limit=0, shared=False, session=None, timeout=5.0):
+        if sqlite3 is None:
+            raise ImportError("the sqlite3 module is not available")
+        self.fname = fname
+        self.limit = limit  # maximum number of lines in the database, 0 for no limit
+        self.shared = shared  # pick up the lines added by other sessions
+        self.session = session  # session id
+        if session is None:
+            self.session = "%s:%d:%x:%x" % (os.uname().nodename, os.getpid(), int(time.time() * 1e6), id(self))
+        self.timeout = timeout  # seconds to wait for another writer
+        self.fts = False  # is there a full-text index?
+        self.id = None  # id of the latest line we have added
+        self.last = 0  # id of the latest line we have read or added
+        self.trimmed = 0  # the lines up to this id have been deleted
+        self.db = None
+        atexit.register(self.close)
+
+    def open(self, n):
+        """open the database, return the latest n lines"""
+        # the history writer uses the connection from its thread
+        self.db = sqlite3.connect(self.fname, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.lock()
+        try:
+            for sql in _HISTORY_SCHEMA:
+                self.db.execute(sql)
+            self.fts = self.create_fts()
+            (first, last) = self.db.execute("SELECT min(id), max(id) FROM history").fetchone()
+            self.trimmed = (first or 1) - 1
+            self.last = last or 0
+            return self.lines(n)
+        finally:
+            self.unlock()
+
+    def create_fts(self):
+        """create the full-text index if sqlite has FTS5, return True if there is one"""
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone():
+            return True
+        try:
+            for sql in _HISTORY_FTS:
+                self.db.execute(sql)
+        except sqlite3.OperationalError:
+            # no FTS5 or no trigram tokenizer (sqlite < 3.34)
+            return False
+        # index any lines added without it
+        self.db.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+        return True
+
+    def lines(self, n):
+        """return the latest n lines, oldest first"""
+        rows = self.db.execute("SELECT line FROM history ORDER BY id DESC LIMIT ?", (n,)).fetchall()
+        return [r[0] for r in reversed(rows)]
+
+    def lock(self):
+        """start a write transaction, return False (the database is never replaced)"""
+        self.db.execute("BEGIN IMMEDIATE")
+        return False
+
+    def unlock(self):
+        """commit the write transaction"""
+        if self.db.in_transaction:
+            self.db.execute("COMMIT")
+
+    def read(self):
+        """return the lines other sessions have added since the last read (lock first)"""
+        if not self.shared:
+            return []
+        rows = self.db.execute(
+            "SELECT id, line FROM history WHERE id > ? AND session != ? ORDER BY id", (self.last, self.session)
+        ).fetchall()
+        if rows:
+            self.last = rows[-1][0]
+        return [r[1] for r in rows]
+
+    def append(self, line):
+        """add a line to the database (lock and read it first)"""
+        try:
+            cwd = os.getcwd()
+        except OSError:
+            cwd = None
+        c = self.db.execute(
+            "INSERT INTO history (line, time, session, cwd) VALUES (?, ?, ?, ?)", (line, time.time(), self.session, cwd)
+        )
+        self.id = self.last = c.lastrowid
+
+    def set_status(self, status):
+        """set the exit status of the latest line we have added"""
+        if self.id is not None:
+            self.db.execute("UPDATE history SET status = ? WHERE id = ?", (status, self.id))
+
+    def full(self, maxlen):
+        """return True if the database has more lines than the limit"""
+        return self.limit > 0 and self.last - self.trimmed > self.limit
+
+    def compact(self, lines):
+        """delete the oldest lines over the limit (lock first), the database keeps its own lines"""
+        self.trimmed = self.last - self.limit
+        self.db.execute("DELETE FROM history WHERE id <= ?", (self.trimmed,))
+
+    def query(self, text="", session=None, n=100):
+        """
+        return the latest n lines containing text as (line, time, session, cwd, status), latest first
+        session: just the lines of this session
+        """
+        sql = "SELECT h.line, h.time, h.session, h.cwd, h.status FROM history h"
+        where = []
+        args = []
+        order = "h.id"
+        if text:
+            if self.fts and len(text) >= 3:
+                # a phrase of trigrams matches the substring, the index yields the latest lines first
+                sql += " JOIN history_fts ON h.id = history_fts.rowid"
+                where.append("history_fts MATCH ?")
+                args.append('"%s"' % text.replace('"', '""'))
+                order = "history_fts.rowid"
+            else:
+                where.append("instr(h.line, ?) > 0")
+                args.append(text)
+        if session is not None:
+            where.append("h.session = ?")
+            args.append(session)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY %s DESC LIMIT ?" % order
+        args.append(n)
+        return self.db.execute(sql, args).fetchall()
+
+    def close(self):
+        """close the database"""
+        if self.db is not None:
+            self.unlock()
+            self.db.close()
+            self.db = None
+        atexit.unregister(self.close)
+
+
+class history_writer:
+    """
+    background thread writing the history file (or database)
+    history_add() queues the lines and returns, so the prompt never waits on disk I/O.
+    The thread waits a while for more lines, then writes them in one batch under one lock and
+    picks up the lines of other sessions. An atexit hook writes any queued lines.
+    """
+
+    def __init__(self, f, delay=1.0, count=64):
+        self.file = f
+        self.delay = delay  # seconds to wait for more lines before writing them
+        self.count = count  # write without waiting once this many operations are queued
+        self.maxlen = 0  # history length, for the compaction test
+        self.cond = threading.Condition()
+        self.ops = []  # queued (file method, argument) operations
+        self.poll = False  # read the lines of other sessions without waiting
+        self.lines = []  # lines read from other sessions
+        self.since = []  # lines read from other sessions that the queued compaction lacks
+        self.replaced = None  # file lines, if another session has replaced the file
+        self.due = False  # is the file due for compaction?
+        self.error = None  # exception raised by the thread
+        self.stop = False
+        self.thread = threading.Thread(target=self.run, name="history writer", daemon=True)
+        self.thread.start()
+        # registered after the file, so it runs before the file is closed
+        atexit.register(self.close)
+
+    def put(self, op, arg):
+        """queue a file operation, a compaction takes the history lines after a take()"""
+        with self.cond:
+            if op == "compact":
+                # the history lines lack the lines not taken yet, and any read from now on
+                self.since = list(self.lines)
+            self.ops.append((op, arg))
+            self.cond.notify()
+
+    def update(self):
+        """read the lines of other sessions now"""
+        with self.cond:
+            self.poll = True
+            self.cond.notify()
+
+    def take(self):
+        """
+        return (replaced, lines) as for the lines read from other sessions since the last take
+        If another session has replaced the file, lines are the file lines and the queued lines.
+        Raise any exception from the thread.
+        """
+        with self.cond:
+            if self.error is not None:
+                (e, self.error) = (self.error, None)
+                raise e
+            if self.replaced is not None:
+                lines = self.replaced + [arg for (op, arg) in self.ops if op == "append"]
+                self.replaced = None
+                self.lines = []
+                return (True, lines)
+            (lines, self.lines) = (self.lines, [])
+            return (False, lines)
+
+    def run(self):
+        """write the queued operations in batches"""
+        while True:
+            with self.cond:
+                while not (self.ops or self.poll or self.stop):
+                    self.cond.wait()
+                # wait a while for more operations
+                end = time.monotonic() + self.delay
+                while self.ops and len(self.ops) < self.count and not self.stop:
+                    t = end - time.monotonic()
+                    if t <= 0:
+                        break
+                    self.cond.wait(t)
+                (ops, self.ops, self.poll) = (self.ops, [], False)
+                stop = self.stop
+            try:
+                self.write(ops)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+            if stop:
+                return
+
+    def write(self, ops):
+        """do a batch of file operations, pick up the lines of other sessions"""
+        f = self.file
+        replaced = f.lock()
+        try:
+            lines = f.read()
+            with self.cond:
+                if f.shared:
+                    if replaced:
+                        self.replaced = lines
+                        self.lines = []
+                        self.since = []
+                    elif self.replaced is not None:
+                        self.replaced.extend(lines)
+                    else:
+                        self.lines.extend(lines)
+                        self.since.extend(lines)
+            for (op, arg) in ops:
+                if op == "compact":
+                    with self.cond:
+                        # keep the lines read since the history was copied, taken or not
+                        lines = arg + self.since if self.replaced is None else None
+                        self.since = []
+                    if lines is not None:
+                        f.compact(lines)
+                    continue
+                getattr(f, op)(arg)
+                if op == "append":
+                    with self.cond:
+                        if self.replaced is not None:
+                            self.replaced.append(arg)
+            self.due = f.full(self.maxlen)
+        finally:
+            f.unlock()
+
+    def close(self):
+        """write the queued operations and stop the thread"""
+        with self.cond:
+            self.stop = True
+            self.cond.notify()
+        self.thread.join()
+        atexit.unregister(self.close)
+        if self.error is not None:
+            raise self.error
 
 
 # -----------------------------------------------------------------------------
@@ -479,15 +3260,30 @@ class linenoise:
     """terminal state"""
 
     def __init__(self):
-        self.history = []  # list of history strings
         self.history_maxlen = 32  # maximum number of history entries (default)
+        self.history = history_ring(self.history_maxlen)  # history strings
+        self.history_index = None  # history search index
+        self.history_prefix = None  # history prefix search index
+        self.history_prefix_keys = None  # (keymap, key bindings) replaced by the history prefix search
+        self.history_file = None  # append-only history file or history database
+        self.history_writer = None  # background history writer
         self.rawmode = False  # are we in raw mode?
         self.mlmode = False  # are we in multiline mode?
+        self.diffmode = False  # are we using differential refresh (single line)?
+        self.refresh_interval = 0.0  # minimum time between line refreshes
         self.atexit_flag = False  # have we registered a cleanup upon exit function?
         self.orig_termios = None  # saved termios attributes
         self.completion_callback = None  # callback function for tab completion
+        self.completion_cache = None  # cache of the line completions
+        self.completion_buffer = _COMPLETION_BUFFER  # maximum number of completions buffered from an iterator
+        self.completion_listing = None  # ask before listing more completions than this, None cycles through them
+        self.completion_deadline = None  # seconds to wait for background completions, None completes in the foreground
         self.hints_callback = None  # callback function for hints
         self.hotkey = None  # character for hotkey
+        self.bracketed_paste = False  # are we using bracketed paste mode?
+        self.inputs = {}  # buffered input streams, keyed by file descriptor
+        self.decoder = key_decoder()  # input to key event decoder
+        self.keymap = keymap(emacs_keymap)  # key bindings
 
     def enable_rawmode(self, fd):
         """Enable raw mode"""
@@ -529,6 +3325,12 @@ class linenoise:
         sys.stdout.flush()
         self.disable_rawmode(_STDIN)
 
+    def get_input(self, fd):
+        """return the buffered input stream for a file descriptor"""
+        if fd not in self.inputs:
+            self.inputs[fd] = input_stream(fd, watch_resize())
+        return self.inputs[fd]
+
     def edit(self, ifd, ofd, prompt, s):
         """
         edit a line in raw mode
@@ -537,134 +3339,65 @@ class linenoise:
         prompt = line prompt string
         s = initial line string
         """
+        if not self.bracketed_paste:
+            return self.edit_line(ifd, ofd, prompt, s)
+        _puts(ofd, _PASTE_ON)
+        try:
+            return self.edit_line(ifd, ofd, prompt, s)
+        finally:
+            _puts(ofd, _PASTE_OFF)
+
+    def edit_line(self, ifd, ofd, prompt, s):
+        """edit a line in raw mode - see edit()"""
         # create the line state
         ls = line_state(ifd, ofd, prompt, self)
+        inp = ls.input
         # set and output the initial line
         ls.edit_set(s)
+        if self.history_file is not None and self.history_file.shared:
+            # pick up the history from other sessions
+            if self.history_writer is not None:
+                self.history_take()
+                self.history_writer.update()
+            else:
+                self.history_update()
+                self.history_file.unlock()
         # The latest history entry is always our current buffer
-        self.history_add(str(ls))
-        while True:
-            c = _getc(ifd)
+        self.history_push(str(ls))
+        # handle all of the pending input before refreshing the line
+        ls.defer = True
+        while not ls.done:
+            if ls.dirty and not inp.pending():
+                # limit the refresh rate, but handle any input that arrives meanwhile
+                wait = ls.refresh_time + self.refresh_interval - time.monotonic()
+                if wait <= 0 or inp.would_block(wait):
+                    ls.flush()
+            if ls.completion is not None and not inp.pending():
+                # wait for a key or the background completions
+                while ls.completion_pending() and inp.would_block(_COMPLETION_POLL):
+                    pass
+                if ls.complete_ready():
+                    c = ls.complete()
+                    if c != _KEY_NULL:
+                        self.edit_key(ls, c)
+                    continue
+            c = self.decoder.get_key(inp)
             if c == _KEY_NULL:
                 # error on read
+                ls.flush()
                 return str(ls)
-            # Autocomplete when the callback is set.
-            # It returns the character that should be handled next.
-            if c == _KEY_TAB and self.completion_callback is not None:
-                c = ls.complete_line()
-                if c == _KEY_NULL:
-                    continue
-            # handle the key code
-            if c == _KEY_ENTER or c == self.hotkey:
-                self.history.pop()
-                if self.hints_callback:
-                    # Refresh the line without hints to leave the
-                    # line as the user typed it after the newline.
-                    hcb = self.hints_callback
-                    self.hints_callback = None
-                    ls.refresh_line()
-                    self.hints_callback = hcb
-                return str(ls) + ("", self.hotkey)[c == self.hotkey]
-            elif c == _KEY_BS:
-                # backspace: remove the character to the left of the cursor
-                ls.edit_backspace()
-            elif c == _KEY_ESC:
-                if would_block(ifd, _CHAR_TIMEOUT):
-                    # looks like a single escape- abandon the line
-                    self.history.pop()
-                    return ""
-                # escape sequence
-                s0 = _getc(ifd, _CHAR_TIMEOUT)
-                s1 = _getc(ifd, _CHAR_TIMEOUT)
-                if s0 == "[":
-                    # ESC [ sequence
-                    if s1 >= "0" and s1 <= "9":
-                        # Extended escape, read additional byte.
-                        s2 = _getc(ifd, _CHAR_TIMEOUT)
-                        if s2 == "~":
-                            if s1 == "3":
-                                # delete
-                                ls.edit_delete()
-                    else:
-                        if s1 == "A":
-                            # cursor up
-                            ls.edit_set(self.history_prev(ls))
-                        elif s1 == "B":
-                            # cursor down
-                            ls.edit_set(self.history_next(ls))
-                        elif s1 == "C":
-                            # cursor right
-                            ls.edit_move_right()
-                        elif s1 == "D":
-                            # cursor left
-                            ls.edit_move_left()
-                        elif s1 == "H":
-                            # cursor home
-                            ls.edit_move_home()
-                        elif s1 == "F":
-                            # cursor end
-                            ls.edit_move_end()
-                elif s0 == "0":
-                    # ESC 0 sequence
-                    if s1 == "H":
-                        # cursor home
-                        ls.edit_move_home()
-                    elif s1 == "F":
-                        # cursor end
-                        ls.edit_move_end()
-                else:
-                    pass
-            elif c == _KEY_CTRL_A:
-                # go to the start of the line
-                ls.edit_move_home()
-            elif c == _KEY_CTRL_B:
-                # cursor left
-                ls.edit_move_left()
-            elif c == _KEY_CTRL_C:
-                # return None == EOF
-                return None
-            elif c == _KEY_CTRL_D:
-                # delete: remove the character to the right of the cursor.
-                # If the line is empty act as an EOF.
-                if len(ls.buf) != 0:
-                    ls.edit_delete()
-                else:
-                    self.history.pop()
-                    return None
-            elif c == _KEY_CTRL_E:
-                # go to the end of the line
-                ls.edit_move_end()
-            elif c == _KEY_CTRL_F:
-                # cursor right
-                ls.edit_move_right()
-            elif c == _KEY_CTRL_H:
-                # backspace: remove the character to the left of the cursor
-                ls.edit_backspace()
-            elif c == _KEY_CTRL_K:
-                # delete to the end of the line
-                ls.delete_to_end()
-            elif c == _KEY_CTRL_L:
-                # clear screen
-                clear_screen()
-                ls.refresh_line()
-            elif c == _KEY_CTRL_N:
-                # next history item
-                ls.edit_set(self.history_next(ls))
-            elif c == _KEY_CTRL_P:
-                # previous history item
-                ls.edit_set(self.history_prev(ls))
-            elif c == _KEY_CTRL_T:
-                # swap current character with the previous
-                ls.edit_swap()
-            elif c == _KEY_CTRL_U:
-                # delete the whole line
-                ls.delete_line()
-            elif c == _KEY_CTRL_W:
-                # delete previous word
-                ls.delete_prev_word()
-            else:
-                # insert the character into the line buffer
-                ls.edit_insert(c)
+            self.edit_key(ls, c)
+        ls.flush()
+        return ls.result
+
+    def edit_key(self, ls, key):
+        """handle a key event"""
+        fn = self.keymap.lookup(key)
+        if fn is not None:
+            fn(ls, key)
+        elif len(key) == 1:
+            # insert the character into the line buffer
+            ls.edit_insert(key)
 
     def read_raw(self, prompt, s):
         """read a line from stdin in raw mode"""
@@ -698,13 +3431,14 @@ class linenoise:
         """
         if self.enable_rawmode(_STDIN) == -1:
             return
+        inp = self.get_input(_STDIN)
         rc = None
         while True:
             if fn():
                 # the loop function has completed
                 rc = True
                 break
-            if _getc(_STDIN, timeout=0.01) == exit_key:
+            if inp.getc(timeout=0.01) == exit_key:
                 # the loop has been cancelled
                 rc = False
                 break
@@ -717,32 +3451,97 @@ class linenoise:
         print("Press keys to see scan codes. Type 'quit' at any time to exit.")
         if self.enable_rawmode(_STDIN) != 0:
             return
+        inp = self.get_input(_STDIN)
         cmd = [""] * 4
         while True:
-            # get a character
-            c = _getc(_STDIN)
-            if c == _KEY_NULL:
+            # get a key
+            key = self.decoder.get_key(inp)
+            if key == _KEY_NULL:
                 continue
-            # display the character
-            if c in string.printable:
-                m = {"\r": "\\r", "\n": "\\n", "\t": "\\t"}
-                cstr = m.get(c, c)
-            else:
-                m = {_KEY_ESC: "ESC"}
-                cstr = m.get(c, "?")
-            sys.stdout.write("'%s' 0x%02x (%d)\r\n" % (cstr, ord(c), ord(c)))
+            # display the characters
+            for c in self.decoder.raw:
+                if c in string.printable:
+                    m = {"\r": "\\r", "\n": "\\n", "\t": "\\t"}
+                    cstr = m.get(c, c)
+                else:
+                    m = {_KEY_ESC: "ESC"}
+                    cstr = m.get(c, "?")
+                sys.stdout.write("'%s' 0x%02x (%d)\r\n" % (cstr, ord(c), ord(c)))
+                # check for quit
+                cmd = cmd[1:]
+                cmd.append(c)
+            # display the decoded key event
+            if len(key) > 1:
+                sys.stdout.write("key: %s\r\n" % (key, repr(key))[key.startswith(_KEY_ESC)])
             sys.stdout.flush()
-            # check for quit
-            cmd = cmd[1:]
-            cmd.append(c)
             if "".join(cmd) == "quit":
                 break
         # restore the original mode
         self.disable_rawmode(_STDIN)
 
     def set_completion_callback(self, fn):
-        """set the completion callback function"""
+        """
+        set the completion callback function
+        fn(line) returns the completed lines, as a list or as an iterator (or generator)
+        """
         self.completion_callback = fn
+        if self.completion_cache is not None:
+            # the cached completions are from the old callback
+            self.completion_cache.clear()
+
+    def completions(self, line):
+        """return the line completions, from the completion cache if it has them"""
+        cache = self.completion_cache
+        if cache is None:
+            return self.completion_callback(line)
+        lc = cache.get(line)
+        if lc is None:
+            lc = self.completion_callback(line)
+            if lc is None or isinstance(lc, (list, tuple)):
+                # an iterator would be used up
+                cache.put(line, [] if lc is None else lc)
+        return lc
+
+    def set_completion_list(self, mode, threshold=100):
+        """
+        complete as bash does: Tab extends the line to the longest common prefix of its completions,
+        otherwise it lists them in columns below the line
+        threshold: ask before listing more completions than this
+        """
+        self.completion_listing = threshold if mode else None
+
+    def set_completion_buffer(self, n):
+        """
+        set the maximum number of completions buffered from a completion callback that returns
+        an iterator (or generator). Completions are pulled from it as Tab steps through them.
+        """
+        self.completion_buffer = max(1, n)
+
+    def set_completion_cache(self, mode, maxsize=128, ttl=_COMPLETION_TTL):
+        """
+        cache the line completions, so Tab on a line that was completed recently doesn't call the
+        completion callback again. The callback can return monotonic_completions(...) to allow
+        the completions of a longer line to be narrowed down from them.
+        maxsize: the number of lines to cache, the least recently used line is evicted
+        ttl: seconds the completions stay valid, 0 for no limit
+        """
+        self.completion_cache = completion_cache(maxsize, ttl) if mode else None
+
+    def completion_stats(self):
+        """return (hits, narrowed, misses) for the completion cache"""
+        cache = self.completion_cache
+        if cache is None:
+            return (0, 0, 0)
+        return (cache.hits, cache.narrowed, cache.misses)
+
+    def set_completion_async(self, mode, deadline=_COMPLETION_DEADLINE):
+        """
+        call the completion callback on a worker thread, so a slow callback doesn't freeze editing
+        deadline: seconds to wait for the completions, after that the line shows they are pending
+        and they are shown when they are ready. Keys typed meanwhile are handled at once,
+        and completions for a line that has changed are dropped.
+        """
+        self.completion_deadline = deadline if mode else None
 
     def set_hints_callback(self, fn):
         """set the hints callback function"""
@@ -752,24 +3551,203 @@ class linenoise:
         """set multiline mode"""
         self.mlmode = mode
 
+    def set_bracketed_paste(self, mode):
+        """
+        set bracketed paste mode
+        The terminal marks pasted text so it is inserted into the line buffer with a single refresh.
+        Pasted tabs are inserted as spaces and hotkeys as text rather than acted upon.
+        """
+        self.bracketed_paste = mode
+
+    def set_diffmode(self, mode):
+        """
+        set differential refresh mode
+        Single line refreshes only output the changes to what is on the screen.
+        This is worth having on slow serial consoles.
+        """
+        self.diffmode = mode
+
+    def set_max_refresh_rate(self, hz):
+        """
+        set the maximum number of line refreshes per second (0 = no limit)
+        Keys that arrive within the refresh interval are handled before the line is refreshed.
+        """
+        self.refresh_interval = 1.0 / hz if hz > 0 else 0.0
+
     def set_hotkey(self, key):
         """
         Set the hotkey. A hotkey will cause line editing to exit.
         The hotkey will be appended to the line buffer but not displayed.
         """
+        if self.hotkey is not None:
+            self.keymap.unbind(self.hotkey)
         self.hotkey = key
+        if key is not None:
+            self.keymap.bind(key, action_hotkey)
+
+    def set_keymap(self, km):
+        """set the keymap used for line editing"""
+        self.keymap = km
+
+    def bind_key(self, key, fn):
+        """bind a key event to an action, fn(ls, key)"""
+        self.keymap.bind(key, fn)
 
     def history_set(self, idx, line):
         """set a history entry by index number"""
-        self.history[len(self.history) - 1 - idx] = line
+        if self.history.get(idx) == line:
+            # Up/Down set the entry they leave, it's usually unchanged
+            return
+        self.history.set(idx, line)
+        self.history_indexed(self.history.seq(idx), line)
+
+    def history_indexed(self, seq, line):
+        """add a history line to the search indexes"""
+        for index in (self.history_index, self.history_prefix):
+            if index is not None:
+                if index.stale(self.history):
+                    index.build(self.history)
+                else:
+                    index.add(seq, line)
+
+    def history_reindex(self):
+        """rebuild the search indexes"""
+        for index in (self.history_index, self.history_prefix):
+            if index is not None:
+                index.build(self.history)
+
+    def history_prefix_matches(self, prefix, before):
+        """
+        yield the sequence numbers of the history lines before 'before' that start with prefix
+        Latest first, with just the latest of any duplicates.
+        """
+        if self.history_prefix is not None:
+            lines = ((l, s) for l, s in self.history_prefix.matches(prefix) if s < before)
+        else:
+            lines = ((l, s) for s, l in self.history.before(before) if l.startswith(prefix))
+        seen = set()
+        for l, s in lines:
+            # skip stale index entries
+            if l not in seen and self.history.by_seq(s) == l:
+                seen.add(l)
+                yield s
+
+    def history_search(self, query, before):
+        """
+        return the sequence number of the latest history line before 'before' that contains query
+        return None if there is no such line
+        """
+        seq = -1
+        if self.history_index is not None:
+            seq = self.history_index.search(self.history, query, before)
+        if seq == -1:
+            # search the history
+            seq = None
+            for s, line in self.history.before(before):
+                if query in line:
+                    seq = s
+                    break
+        return seq
+
+    def set_history_index(self, mode):
+        """
+        index the history for searches (Ctrl-R)
+        This costs memory, but keeps searches fast with very large histories.
+        """
+        if mode:
+            self.history_index = history_index()
+            self.history_index.build(self.history)
+        else:
+            self.history_index = None
+
+    def set_history_prefix_search(self, mode):
+        """
+        Up/Down visit just the history lines starting with the text left of the cursor
+        The history is indexed for prefix searches. Turning it off restores the earlier Up/Down bindings.
+        """
+        actions = {_KEY_UP: action_history_prefix_prev, _KEY_DOWN: action_history_prefix_next}
+        if mode:
+            if self.history_prefix is None:
+                # save the bindings to restore
+                self.history_prefix_keys = (self.keymap, {key: self.keymap.keys.get(key) for key in actions})
+            self.history_prefix = history_prefix()
+            self.history_prefix.build(self.history)
+            for key, fn in actions.items():
+                self.keymap.bind(key, fn)
+        elif self.history_prefix is not None:
+            self.history_prefix = None
+            (km, saved) = self.history_prefix_keys
+            self.history_prefix_keys = None
+            for key, fn in saved.items():
+                # leave keys that have been bound since
+                if km.keys.get(key) is actions[key]:
+                    if fn is None:
+                        km.unbind(key)
+                    else:
+                        km.bind(key, fn)
+
+    def set_history_frecency(self, mode, maxbytes=0, half_life=_HALF_LIFE):
+        """
+        rank the history lines by frecency (uses, decaying with age), evict the least frecent line
+        Duplicates are erased as for set_history_unique().
+        maxbytes: also bound the size of the history lines in bytes, 0 for no limit
+        half_life: the time (in seconds) for the frecency of a use to halve
+        """
+        self.history_store(history_frecent, mode, maxbytes, half_life)
+
+    def history_ranked(self, prefix="", n=10):
+        """
+        return up to n history lines that start with (and aren't) prefix, best first
+        With frecency the most frecent lines are best, otherwise the latest.
+        This is the ranking for history based suggestions.
+        """
+        seqs = self.history_prefix_matches(prefix, self.history.seq(0) + 1)
+        lines = (l for l in map(self.history.by_seq, seqs) if l != prefix)
+        if isinstance(self.history, history_frecent):
+            return heapq.nlargest(n, lines, key=lambda l: self.history.stats[l][0])
+        return list(itertools.islice(lines, n))
+
+    def set_history_packed(self, mode):
+        """
+        pack the history lines into one buffer, decoding them as they are used
+        This cuts the memory used by very large histories several-fold.
+        """
+        self.history_store(history_packed, mode)
+
+    def set_history_unique(self, mode):
+        """
+        erase older duplicates: adding a line already in the history moves it to the latest entry
+        This isn't supported by lazy history loading, which loads the history file in full instead.
+        """
+        self.history_store(history_unique, mode)
+
+    def history_store(self, cls, mode, *args):
+        """
+        switch the history to (or back from) a store class, keeping the history lines
+        The packed, unique and frecent stores don't combine, switching from one to another raises ValueError.
+        Turning off a mode that isn't on does nothing. A lazily loaded history is loaded in full.
+        """
+        h = self.history
+        if mode:
+            if type(h) not in (history_ring, history_mmap, cls):
+                raise ValueError("%s history can't be combined with %s" % (type(h).__name__, cls.__name__))
+            store = cls(self.history_maxlen, *args)
+        elif type(h) is cls:
+            store = history_ring(self.history_maxlen)
+        else:
+            return
+        for line in h:
+            store.append(line)
+        self.history = store
+        self.history_reindex()
 
     def history_get(self, idx):
         """get a history entry by index number"""
-        return self.history[len(self.history) - 1 - idx]
+        return self.history.get(idx)
 
     def history_list(self):
-        """return the full history list"""
-        return self.history
+        """return a view of the full history, oldest entry first"""
+        return history_view(self.history)
 
     def history_next(self, ls):
         """return next history item"""
@@ -795,46 +3773,174 @@ class linenoise:
             ls.history_idx = len(self.history) - 1
         return self.history_get(ls.history_idx)
 
-    def history_add(self, line):
-        """Add a new entry to the history"""
+    def history_push(self, line):
+        """add a line to the in-memory history, return True if it was added"""
         if self.history_maxlen == 0:
-            return
+            return False
         # don't re-add the last entry
         if len(self.history) != 0 and line == self.history[-1]:
-            return
-        # add the line to the history
-        if len(self.history) == self.history_maxlen:
-            # remove the first entry
-            self.history.pop(0)
+            if isinstance(self.history, history_frecent):
+                # but count the use
+                self.history.touch()
+            return False
+        # add the line to the history, the oldest entry is evicted when it's full
         self.history.append(line)
+        self.history_indexed(self.history.seq(0), line)
+        return True
+
+    def history_add(self, line):
+        """Add a new entry to the history"""
+        f = self.history_file
+        if f is None:
+            self.history_push(line)
+            return
+        w = self.history_writer
+        if w is not None:
+            # queue the file operations for the writer thread
+            self.history_take()
+            w.maxlen = self.history_maxlen
+            if w.due:
+                w.due = False
+                w.put("compact", list(self.history))
+            if self.history_push(line):
+                w.put("append", line)
+            return
+        self.history_update()
+        try:
+            if self.history_push(line):
+                f.append(line)
+                if f.full(self.history_maxlen):
+                    f.compact(self.history)
+        finally:
+            f.unlock()
+
+    def history_update(self):
+        """lock the history file, add any lines other sessions have appended to the history"""
+        f = self.history_file
+        replaced = f.lock()
+        try:
+            lines = f.read()
+            if f.shared:
+                if replaced:
+                    self.history_replace(lines)
+                else:
+                    for l in lines:
+                        self.history_push(l)
+        except BaseException:
+            f.unlock()
+            raise
+
+    def history_take(self):
+        """add the lines the history writer has read from other sessions"""
+        (replaced, lines) = self.history_writer.take()
+        if replaced:
+            self.history_replace(lines)
+        else:
+            for l in lines:
+                self.history_push(l)
+
+    def set_history_writer(self, mode, delay=1.0, count=64):
+        """
+        write the open history file (or database) from a background thread
+        history_add() doesn't wait on disk I/O, the lines of other sessions show up a prompt later.
+        delay: seconds to wait for more lines to write them together
+        count: write without waiting once this many lines are queued
+        """
+        if self.history_writer is not None:
+            (w, self.history_writer) = (self.history_writer, None)
+            w.close()
+        if mode and self.history_file is not None:
+            self.history_writer = history_writer(self.history_file, delay, count)
 
     def history_set_maxlen(self, n):
         """Set the maximum length for the history. Truncate the current history if needed."""
         if n < 0:
             return
         self.history_maxlen = n
-        current_length = len(self.history)
-        if current_length > self.history_maxlen:
-            # truncate and retain the latest history
-            self.history = self.history[current_length - self.history_maxlen :]
+        # truncate and retain the latest history
+        self.history.set_maxlen(n)
 
     def history_save(self, fname):
         """Save the history to a file"""
-        old_umask = os.umask(stat.S_IXUSR | stat.S_IRWXG | stat.S_IRWXO)
-        f = open(fname, "w")
-        os.umask(old_umask)
-        os.chmod(fname, stat.S_IRUSR | stat.S_IWUSR)
-        f.write("%s\n" % "\n".join(self.history))
-        f.close()
+        if self.history_file is not None and self.history_file.fname == fname:
+            # history_add() has already appended the lines
+            return
+        _history_write(fname, self.history)
 
-    def history_load(self, fname):
-        """Load history from a file"""
-        self.history = []
+    def history_load(self, fname, lazy=False):
+        """
+        Load history from a file
+        lazy: memory map the file and decode the history lines as they are used,
+        a packed, unique or frecent history is loaded in full
+        """
+        if isinstance(self.history_file, history_db) and self.history_file.fname == fname:
+            # reload the latest lines from the database
+            self.history_replace(self.history_file.lines(self.history_maxlen))
+            return
+        if lazy and fname and os.path.isfile(fname) and type(self.history) in (history_ring, history_mmap):
+            self.history = history_mmap(fname, self.history_maxlen)
+            self.history_reindex()
+            return
+        x = []
         if fname and os.path.isfile(fname):
             f = open(fname, "r")
             x = f.readlines()
             f.close()
-            self.history = [l.strip() for l in x]
+        self.history_replace(x)
+
+    def history_replace(self, lines):
+        """replace the history with the latest lines"""
+        self.history.clear()
+        for l in lines[-self.history_maxlen :] if self.history_maxlen else ():
+            self.history.append(l.strip())
+        self.history_reindex()
+
+    def history_open(self, fname, sync=0, limit=0, shared=False):
+        """
+        Load the history from a file and keep it open, history_add() appends each new line to it.
+        sync: fsync the file after this many lines, 0 leaves it to the OS
+        limit: rewrite the file with the retained history when it has more lines than this,
+        0 is twice the maximum history length, the limit is at least 1.5 times that length
+        shared: the file is shared with other sessions, pick up the lines they append
+        """
+        self.history_close()
+        f = history_file(fname, sync, limit, shared)
+        self.history_replace(f.open())
+        self.history_file = f
+
+    def history_open_db(self, fname, limit=0, shared=False, session=None):
+        """
+        Open a history database and load the latest lines, history_add() adds each new line to it.
+        limit: the maximum number of lines in the database, 0 for no limit
+        shared: pick up the lines other sessions add
+        session: the session id stored with the lines, None for a unique id
+        """
+        self.history_close()
+        f = history_db(fname, limit, shared, session)
+        self.history_replace(f.open(self.history_maxlen))
+        self.history_file = f
+
+    def history_set_status(self, status):
+        """set the exit status of the latest line added to the history database"""
+        if isinstance(self.history_file, history_db):
+            if self.history_writer is not None:
+                self.history_writer.put("set_status", status)
+            else:
+                self.history_file.set_status(status)
+
+    def history_query(self, text="", session=None, n=100):
+        """
+        query the history database (see history_db.query), the history needn't be in memory
+        return the latest n lines containing text as (line, time, session, cwd, status), latest first
+        """
+        return self.history_file.query(text, session, n)
+
+    def history_close(self):
+        """close the history file"""
+        self.set_history_writer(False)
+        if self.history_file is not None:
+            self.history_file.close()
+            self.history_file = None
 
 
 # -----------------------------------------------------------------------------
@@ -0,0 +1,58 @@
+"""
+test fixtures
+"""
+
+import os
+import pty
+import tty
+import time
+import fcntl
+import struct
+import termios
+import threading
+import pytest
+
+# -----------------------------------------------------------------------------
+
+
+def edit_session(ln, keys, prompt="> ", s=""):
+    """
+    run ln.edit() on a pty, typing the keys, return (result, terminal output)
+    keys is a string, or a list of strings with float pauses (in seconds) between them
+    """
+    m, sl = pty.openpty()
+    tty.setraw(sl)
+    fcntl.ioctl(sl, termios.TIOCSWINSZ, struct.pack("HHHH", 24, 80, 0, 0))
+    output = []
+
+    def reader():
+        while True:
+            try:
+                data = os.read(m, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            output.append(data)
+
+    def writer():
+        for k in [keys] if isinstance(keys, str) else keys:
+            if isinstance(k, float):
+                time.sleep(k)
+            else:
+                os.write(m, k.encode("utf8"))
+
+    rt = threading.Thread(target=reader, daemon=True)
+    rt.start()
+    threading.Thread(target=writer, daemon=True).start()
+    result = ln.edit(sl, sl, prompt, s)
+    time.sleep(0.05)
+    os.close(sl)
+    rt.join(1)
+    os.close(m)
+    return (result, b"".join(output))
+
+
+@pytest.fixture
+def session():
+    return edit_session
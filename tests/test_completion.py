@@ -0,0 +1,44 @@
+"""
+tests for the linenoise completions
+"""
+
+import time
+import pytest
+import linenoise
+
+# -----------------------------------------------------------------------------
+
+
+def slow_completion(line):
+    time.sleep(0.5)
+    return [line + "x"]
+
+
+@pytest.mark.parametrize("key, result", [("\r", "ab"), ("\x03", None)])
+def test_pending_marker_removed(session, key, result):
+    ln = linenoise.linenoise()
+    ln.set_completion_callback(slow_completion)
+    ln.set_completion_async(True)
+    (line, output) = session(ln, ["ab\t", 0.2, key])
+    assert line == result
+    # the last refresh of the line has no marker
+    assert linenoise._COMPLETION_PENDING.encode() not in output[output.rfind(b"\r> ") :]
+
+
+def test_cache_cleared_by_new_callback():
+    ln = linenoise.linenoise()
+    ln.set_completion_cache(True)
+    ln.set_completion_callback(lambda line: [line + "A"])
+    assert ln.completions("a") == ["aA"]
+    ln.set_completion_callback(lambda line: [line + "B"])
+    assert ln.completions("a") == ["aB"]
+
+
+def test_fuzzy_pool_matches_serial():
+    names = ["show interfaces", "ip_route", "IfConfig", "if-config"] * 50
+    fm = linenoise.fuzzy_matcher(lambda line: names, parallel=1, workers=2)
+    try:
+        assert fm.scores("ifc", names) == linenoise.fuzzy_scores("ifc", names)
+        assert fm("ifc")[0] == "IfConfig"
+    finally:
+        fm.close()
@@ -0,0 +1,243 @@
+"""
+tests for the linenoise history stores
+"""
+
+import os
+import time
+import random
+import threading
+import pytest
+import linenoise
+
+# -----------------------------------------------------------------------------
+
+
+def test_set_unchanged_line_not_reindexed():
+    ln = linenoise.linenoise()
+    ln.set_history_index(True)
+    ln.set_history_prefix_search(True)
+    for l in ["ls", "make", "git status"]:
+        ln.history_add(l)
+    adds = (ln.history_index.adds, ln.history_prefix.adds)
+    # Up/Down set the entries they leave
+    for idx in (0, 1, 2, 1, 0):
+        ln.history_set(idx, ln.history_get(idx))
+    assert (ln.history_index.adds, ln.history_prefix.adds) == adds
+    ln.history_set(1, "make x")
+    assert ln.history_prefix.adds == adds[1] + 1
+
+
+def test_file_limit_below_maxlen(tmp_path):
+    ln = linenoise.linenoise()
+    ln.history_set_maxlen(100)
+    ln.history_open(str(tmp_path / "history"), limit=10)
+    f = ln.history_file
+    compactions = []
+    compact = f.compact
+    f.compact = lambda lines: compactions.append(len(lines)) or compact(lines)
+    for i in range(250):
+        ln.history_add("line %d" % i)
+    # compacted at 151 lines, the next compaction is due after another 51 lines
+    assert compactions == [100, 100]
+    ln.history_close()
+    ln.history_load(str(tmp_path / "history"))
+    assert list(ln.history_list()) == ["line %d" % i for i in range(150, 250)]
+
+
+class os_proxy:
+    """linenoise's os module, with a hook on os.replace() and a pause after the next os.close()"""
+
+    def __init__(self, on_replace):
+        self.on_replace = on_replace
+        self.pause = False
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+        self.pause = True
+        self.on_replace()
+
+    def close(self, fd):
+        os.close(fd)
+        if self.pause:
+            self.pause = False
+            time.sleep(0.3)
+
+
+def test_shared_file_compaction_race(tmp_path, monkeypatch):
+    fname = str(tmp_path / "history")
+    a = linenoise.linenoise()
+    a.history_set_maxlen(4)
+    a.history_open(fname, shared=True)
+    b = linenoise.linenoise()
+    b.history_open(fname, shared=True)
+    for i in range(8):
+        a.history_add("a%d" % i)
+    # b appends while a is compacting the file
+    t = threading.Thread(target=b.history_add, args=("theirs",))
+    monkeypatch.setattr(linenoise, "os", os_proxy(t.start))
+    a.history_add("a8")
+    monkeypatch.undo()
+    t.join()
+    a.history_add("a9")
+    assert list(a.history_list()) == ["a7", "a8", "theirs", "a9"]
+    a.history_close()
+    b.history_close()
+    with open(fname) as f:
+        assert f.read().splitlines() == ["a5", "a6", "a7", "a8", "theirs", "a9"]
+
+
+def unique_stores():
+    return (linenoise.history_unique(32), linenoise.history_frecent(32))
+
+
+def history(store, lines):
+    for l in lines:
+        store.append(l)
+    return store
+
+
+@pytest.mark.parametrize("h", unique_stores())
+def test_unique_pop_restores_erased_line(h):
+    # edit(..., "make"), type " x", Up, Enter
+    history(h, ["ls", "make", "git status"])
+    h.append("make")
+    h.set(0, "make x")
+    h.pop()
+    assert list(h) == ["ls", "make", "git status"]
+
+
+@pytest.mark.parametrize("h", unique_stores())
+def test_unique_set_keeps_live_copy(h):
+    # type "ls", Up, Down, Enter, history_add("ls")
+    history(h, ["ls", "make", "git status"])
+    h.append("")
+    h.set(0, "ls")
+    h.set(1, "git status")
+    h.pop()
+    h.append("ls")
+    assert list(h) == ["make", "git status", "ls"]
+
+
+def test_prefix_matches_latest_first():
+    rng = random.Random(1)
+    ln = linenoise.linenoise()
+    ln.history_set_maxlen(50)
+    ln.set_history_prefix_search(True)
+    for _ in range(500):
+        line = "".join(rng.choice("abc") for _ in range(rng.randint(0, 4)))
+        if rng.random() < 0.1:
+            ln.history_set(rng.randrange(len(ln.history)), line)
+        else:
+            ln.history_add(line)
+        for prefix in ("", "a", "bc"):
+            before = ln.history.seq(0) + 1
+            matches = list(ln.history_prefix_matches(prefix, before))
+            # the same as a scan of the history
+            (index, ln.history_prefix) = (ln.history_prefix, None)
+            assert matches == list(ln.history_prefix_matches(prefix, before))
+            ln.history_prefix = index
+
+
+def test_prefix_search_restores_keys():
+    def up(ls, key):
+        pass
+
+    ln = linenoise.linenoise()
+    ln.bind_key("up", up)
+    ln.set_history_prefix_search(True)
+    ln.set_history_prefix_search(True)
+    assert ln.keymap.lookup("up") is linenoise.action_history_prefix_prev
+    ln.set_history_prefix_search(False)
+    assert ln.keymap.lookup("up") is up
+    assert ln.keymap.lookup("down") is linenoise.action_history_next
+    # bindings made while prefix search is on are kept
+    ln.set_history_prefix_search(True)
+    ln.bind_key("down", up)
+    ln.set_history_prefix_search(False)
+    assert ln.keymap.lookup("up") is up
+    assert ln.keymap.lookup("down") is up
+
+
+def test_frecent_pop_restores_stats():
+    h = history(linenoise.history_frecent(32), ["ls", "make", "make", "git status"])
+    stats = list(h.stats["make"])
+    h.append("make")
+    h.set(0, "make x")
+    h.pop()
+    assert h.stats["make"] == stats
+    assert set(h.stats) == {"ls", "make", "git status"}
+    assert h.bytes == len("lsmakegit status")
+    # the restored line can still be evicted
+    h.set_maxlen(1)
+    assert list(h) == ["git status"]
+
+
+def test_frecent_counts_repeated_line():
+    ln = linenoise.linenoise()
+    ln.set_history_frecency(True)
+    ln.history_set_maxlen(3)
+    for l in ["make"] * 10 + ["ls", "vim"]:
+        ln.history_add(l)
+    assert ln.history.stats["make"][1] == 10
+    # the least frecent line is evicted
+    ln.history_add("git")
+    assert list(ln.history_list()) == ["make", "vim", "git"]
+
+
+def test_writer_compact_keeps_taken_lines(tmp_path):
+    fname = str(tmp_path / "history")
+    f = linenoise.history_file(fname, shared=True)
+    f.open()
+    other = linenoise.history_file(fname, shared=True)
+    other.open()
+    # the thread waits for more operations until it's closed
+    w = linenoise.history_writer(f, delay=60.0)
+    w.put("compact", ["mine"])
+    # a batch reads another session's line, the next prompt takes it before the compaction
+    other.lock()
+    other.read()
+    other.append("theirs")
+    other.unlock()
+    w.write([])
+    assert w.take() == (False, ["theirs"])
+    w.close()
+    f.close()
+    other.close()
+    with open(fname) as fd:
+        assert fd.read().splitlines() == ["mine", "theirs"]
+
+
+def test_history_modes_conflict():
+    ln = linenoise.linenoise()
+    ln.set_history_packed(True)
+    for l in ("ls", "make"):
+        ln.history_add(l)
+    with pytest.raises(ValueError):
+        ln.set_history_unique(True)
+    with pytest.raises(ValueError):
+        ln.set_history_frecency(True)
+    # turning off a mode that isn't on leaves the history as it is
+    ln.set_history_unique(False)
+    assert isinstance(ln.history, linenoise.history_packed)
+    ln.set_history_packed(False)
+    ln.set_history_frecency(True)
+    assert list(ln.history_list()) == ["ls", "make"]
+
+
+def test_lazy_load_keeps_mode(tmp_path):
+    fname = str(tmp_path / "history")
+    with open(fname, "w") as f:
+        f.write("ls\nmake\nls\n")
+    ln = linenoise.linenoise()
+    ln.set_history_packed(True)
+    ln.history_load(fname, lazy=True)
+    assert isinstance(ln.history, linenoise.history_packed)
+    assert list(ln.history_list()) == ["ls", "make", "ls"]
+    # a mode set after lazy loading loads the history in full
+    ln = linenoise.linenoise()
+    ln.history_load(fname, lazy=True)
+    ln.set_history_unique(True)
+    assert list(ln.history_list()) == ["make", "ls"]
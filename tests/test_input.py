@@ -0,0 +1,56 @@
+"""
+tests for the linenoise input decoding
+"""
+
+import os
+import linenoise
+
+# -----------------------------------------------------------------------------
+
+
+def keys(data):
+    """return the key events decoded from the input data"""
+    r, w = os.pipe()
+    os.write(w, data)
+    os.close(w)
+    inp = linenoise.input_stream(r)
+    decoder = linenoise.key_decoder()
+    events = []
+    while True:
+        k = decoder.get_key(inp, 0)
+        if k == linenoise._KEY_NULL:
+            break
+        events.append(k)
+    os.close(r)
+    return events
+
+
+def test_paste_tab():
+    assert linenoise.paste_filter("a\tb\r\nc\x07") == "a b c"
+
+
+def test_escape_prefix_timeout():
+    assert keys(b"\x1bO") == ["M-O"]
+    assert keys(b"\x1b[") == ["M-["]
+    assert keys(b"\x1bOA\x1bb") == ["up", "M-b"]
+
+
+def test_paste_tab_edit(session):
+    ln = linenoise.linenoise()
+    ln.set_bracketed_paste(True)
+    (line, output) = session(ln, "\x1b[200~a\tb\x1b[201~\r")
+    assert line == "a b"
+    assert b"\t" not in output
+
+
+def test_cursor_position_keeps_keys():
+    r, w = os.pipe()
+    out_r, out_w = os.pipe()
+    os.write(w, b"ab\x1b[5;42Rcd")
+    os.close(w)
+    inp = linenoise.input_stream(r)
+    assert linenoise.get_cursor_position(inp, out_w) == 42
+    assert os.read(out_r, 16) == b"\x1b[6n"
+    assert [inp.getc(0) for _ in range(5)] == ["a", "b", "c", "d", linenoise._KEY_NULL]
+    for fd in (r, out_r, out_w):
+        os.close(fd)